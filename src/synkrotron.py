@@ -22,26 +22,49 @@ A tool for synchronizing local and remote directories with client-side encryptio
 """
 
 import argparse
-import bisect
+import array
+import base64
+import collections
+import collections.abc
 from concurrent import futures
 import configparser
+import contextlib
+import cProfile
+import ctypes
 import fnmatch
 import hashlib
+import heapq
+import hmac
 import inspect
 import io
+import json
 import os
 import pickle
+import queue
+import re
+import resource
+import select
+import shlex
 import shutil
 import signal
 import stat
+import struct
 import subprocess
 import sys
+import threading
+import time
+import xml.etree.ElementTree
+import zlib
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes # optional (faster name encryption)
+except ImportError:
+    Cipher = None
 
 
 class Remote:
     """Provides access to a remote directory by handling mounting and encryption."""
     
-    def __init__(self, name, location, sync_dir, *, key='', mount_point=''):
+    def __init__(self, name, location, sync_dir, *, key='', mount_point='', cache_hashes=False, name_cache_size=0, direct_transfer=False, transport=None):
         """
         Create remote directory wrapper.
         
@@ -50,6 +73,10 @@ class Remote:
         sync_dir: path of the synchronization directory ("<local directory>/.synkrotron")
         key: encryption key (optional)
         mount_point: path where the remote directory should be mounted (optional, this is created dynamically and the last component must not exist before mounting)
+        cache_hashes: keep a persistent cache of the content hashes of the reverse-mounted local directory (default is False)
+        name_cache_size: maximum number of cached encrypted names (default is 0, i.e., unbounded)
+        direct_transfer: copy files with rsync over ssh instead of through the sshfs mount (default is False, only used for directories on a remote server)
+        transport: Transport object for connecting to the remote server (default is ssh)
         """
         self.name = name
         self.location = location
@@ -65,6 +92,14 @@ class Remote:
         self.mount_point = mount_point
         self.mount_path = None
         self.reverse_mount_path = None
+        self.cache_hashes = cache_hashes
+        self.reverse_hash_cache = None
+        self.name_cache = None
+        self.name_cache_size = name_cache_size
+        self.direct_transfer = direct_transfer
+        self.transport = transport or Transport()
+        self._name_codec = None
+        self._agent = None
     
     def _sync_path(self, dir_name):
         return os.path.join(self.sync_dir, self.name + '-' + dir_name)
@@ -73,6 +108,45 @@ class Remote:
         """Check whether the directory is located on a remote server."""
         return ':' not in self.location
     
+    def is_direct(self):
+        """Check whether files are copied with rsync over ssh, so the directory does not need to be mounted."""
+        return bool(self.direct_transfer) and not self.is_local()
+    
+    def connect(self):
+        """
+        Prepare direct transfers instead of mounting the directory (see Remote.is_direct).
+        
+        For an encrypted directory, the encfs configuration is copied from the remote server since names are encrypted locally.
+        The directory is mounted instead if it was not encrypted before.
+        """
+        if self.key:
+            config = self.agent().call('read', os.path.join(self.root, '.encfs6.xml'))
+            if config is None:
+                self.direct_transfer = False
+                self.mount() # encfs creates the configuration
+                return
+            target = self._sync_path('encfs-config')
+            if not os.path.exists(target):
+                os.mkdir(target)
+            with io.open(os.path.join(target, '.encfs6.xml'), 'wb') as f:
+                f.write(config)
+            self.encfs_source = target
+    
+    def clear_remote(self):
+        """Return a (mounted) Remote object for the unencrypted files, which are stored in the "clear" directory of an encrypted directory."""
+        if self.is_direct():
+            clear_root = os.path.join(self.root, 'clear')
+            self.agent().call('mkdir', clear_root)
+            remote = Remote('', '%s:%s' % (self.host, clear_root), self.sync_dir, direct_transfer=True, transport=self.transport)
+            remote._agent = self.agent() # share the connection
+        else:
+            clear_root = os.path.join(self.encfs_source, 'clear')
+            if not os.path.exists(clear_root):
+                os.mkdir(clear_root)
+            remote = Remote('', clear_root, self.sync_dir)
+            remote.mount() # does nothing but setting the mount path
+        return remote
+    
     def mount(self):
         """Mount the directory and return the mount point."""
         if self.mount_path != None:
@@ -83,7 +157,7 @@ class Remote:
             if not os.path.ismount(target):
                 if not os.path.exists(target):
                     os.mkdir(target)
-                if execute(['sshfs', '-o', 'idmap=user', path, target]) != 0:
+                if execute(['sshfs', '-o', 'idmap=user'] + self.transport.sshfs_options() + [path, target]) != 0:
                     raise Exception('unable to mount %s with sshfs' % path)
             path = target
         if self.key: # decrypt with encfs
@@ -123,11 +197,27 @@ class Remote:
                     if execute(['fusermount', '-u', path]) != 0:
                         raise('unmounting %s at %s failed' % (fs_type, path))
                 os.rmdir(path)
+        if self._name_codec is not None:
+            self._name_codec.close()
+            self._name_codec = None
         if self.key:
             fuse_umount('encfs')
         if not self.is_local():
             fuse_umount('sshfs')
         self.mount_path = None
+        self.disconnect()
+    
+    def agent(self):
+        """Return the agent process serving requests on the remote server (started on first use)."""
+        if self._agent is None:
+            self._agent = RemoteAgent(self.transport.shell(self.host))
+        return self._agent
+    
+    def disconnect(self):
+        """Stop the agent process in case it was started."""
+        if self._agent is not None:
+            self._agent.close()
+            self._agent = None
     
     def reverse_mount(self):
         """
@@ -147,33 +237,37 @@ class Remote:
             env = {'ENCFS6_CONFIG':os.path.join(self.encfs_source, '.encfs6.xml')}
             if execute(['encfs', '--stdinpass', '--reverse', os.path.dirname(self.sync_dir), self.encfs_reverse], process_input=self.key, env=env) != 0:
                 raise Exception('unable to reverse mount %s with encfs' % self.encfs_reverse)
+        if self.cache_hashes and self.reverse_hash_cache is None:
+            # the encrypted contents depend on the key
+            cache_file = self._sync_path('hashes-' + hashlib.md5(self.key.encode()).hexdigest())
+            self.reverse_hash_cache = HashCache(cache_file, self.encfs_reverse)
         return self.encfs_reverse
     
     def reverse_umount(self):
         """Unmount the local directory when it was mounted before in reverse mode."""
+        if self.reverse_hash_cache is not None:
+            # save while mounted, since hashes of files that do not exist anymore are evicted
+            self.reverse_hash_cache.save()
+            self.reverse_hash_cache = None
         if execute(['fusermount', '-u', self.encfs_reverse]) != 0:
             raise('unmounting encfs (reverse mode) at %s failed' % self.encfs_reverse)
         else:
             os.rmdir(self.encfs_reverse)
     
     def save_cache(self):
-        """Write the encryption cache to disk."""
-        if hasattr(self, '_cache'):
-            with io.open(self._cache_file, 'wb') as f:
-                pickle.dump(self._cache, f)
+        """Write the new entries of the name cache to disk."""
+        if self.name_cache is not None:
+            self.name_cache.save()
     
     def _load_cache(self):
-        """Read the encryption cache from disk."""
-        if not hasattr(self, '_cache'):
-            self._cache_file = self._sync_path('cache-' + hashlib.md5(self.key.encode()).hexdigest())
-            try:
-                with io.open(self._cache_file, 'rb') as f:
-                    self._cache = pickle.load(f)
-            except:
-                self._cache = (dict(), dict()) # encrypted->clear, clear->encrypted
+        """Return the name cache (its entries are read from disk on first use)."""
+        if self.name_cache is None:
+            cache_file = self._sync_path('names-' + hashlib.md5(self.key.encode()).hexdigest())
+            self.name_cache = NameCache(cache_file, max_entries=self.name_cache_size)
+        return self.name_cache
     
     def decrypt_names(self, filenames):
-        """Decrypt filenames in case key is set."""
+        """Decrypt filenames in case key is set (filenames with a component that can not be decrypted are None)."""
         return self._map_names('decode', filenames)
     
     def encrypt_names(self, filenames):
@@ -183,17 +277,620 @@ class Remote:
     def _map_names(self, command, filenames):
         if not filenames:
             return []
-        self._load_cache()
-        cache_index = 0 if command == 'decrypt' else 1
+        cache = self._load_cache()
+        lookup = cache.decrypt if command == 'decode' else cache.encrypt
         filenames = [fn.split(os.sep) for fn in filenames]
-        uncached = [c for fn in filenames for c in fn if c not in self._cache[cache_index]]
+        mapped = dict() # name component -> mapped name component (kept for this call since the cache might evict entries)
+        uncached = []
+        for c in dict.fromkeys(c for fn in filenames for c in fn):
+            m = lookup(c)
+            if m is None:
+                uncached.append(c)
+            else:
+                mapped[c] = m
         if uncached:
-            process_input = '\n'.join(uncached)
-            _, output = execute(['encfsctl', command, '--extpass=echo %s' % self.key, self.encfs_source], process_input=process_input, return_stdout=True)
-            for c, mapped in zip(uncached, str(output, 'utf_8').split('\n')):
-                self._cache[cache_index][c] = mapped
-                self._cache[1 - cache_index][mapped] = c
-        return [os.sep.join([self._cache[cache_index][c] for c in fn]) for fn in filenames]
+            if self._name_codec is None:
+                # fall back to encfsctl for configurations not supported by the in-process codec
+                self._name_codec = EncfsCodec.load(self.key, self.encfs_source) or NameCodec(self.key, self.encfs_source)
+            with metrics.phase('names'):
+                mapped_uncached = self._name_codec.map(command, uncached)
+            metrics.add('names', files=len(uncached))
+            for c, m in zip(uncached, mapped_uncached):
+                if not m and c:
+                    mapped[c] = None # invalid name (encfsctl prints an empty line), which is never cached
+                    continue
+                mapped[c] = m
+                if command == 'decode':
+                    cache.store(m, c)
+                else:
+                    cache.store(c, m)
+        mapped_names = []
+        for fn in filenames:
+            components = [mapped[c] for c in fn]
+            mapped_names.append(None if None in components else os.sep.join(components))
+        return mapped_names
+
+
+class Transport:
+    """Connection to remote servers over ssh, which is used for remote agents, sshfs, and rsync."""
+    
+    def shell(self, host):
+        """Return the command prefix for executing a shell command on the host."""
+        return ['ssh', host]
+    
+    def sshfs_options(self):
+        """Return additional sshfs options."""
+        return []
+    
+    def rsync_options(self):
+        """Return additional rsync options for transfers from or to "host:path" locations."""
+        return []
+
+
+class LoopbackTransport(Transport):
+    """
+    Local stand-in for ssh: commands are executed on this machine by a relay process, which optionally delays and throttles all data.
+    
+    The host name is ignored, so "host:path" refers to the local path.
+    This allows for testing and benchmarking the remote code paths without a network.
+    """
+    
+    # options of ssh that take an argument
+    _ssh_arg_options = set('BbcDEeFIiJLlmOopQRSWw')
+    # locations of the sftp server (used by sshfs)
+    _sftp_servers = ['/usr/lib/openssh/sftp-server', '/usr/libexec/openssh/sftp-server', '/usr/lib/ssh/sftp-server', '/usr/libexec/sftp-server']
+    
+    def __init__(self, *, rtt=0.0, bandwidth=0):
+        """
+        Create the transport.
+        
+        rtt: round-trip time in seconds (default is 0, data in each direction is delayed by half of it)
+        bandwidth: maximum number of bytes per second in each direction (default is 0, i.e., unlimited)
+        """
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+    
+    def _command(self):
+        return [sys.executable, os.path.abspath(__file__), '--relay', repr(float(self.rtt)), str(int(self.bandwidth))]
+    
+    def shell(self, host):
+        return self._command() + [host]
+    
+    def sshfs_options(self):
+        return ['-o', 'ssh_command=' + ' '.join(self._command())]
+    
+    def rsync_options(self):
+        return ['-e', ' '.join(shlex.quote(arg) for arg in self._command())]
+    
+    @staticmethod
+    def _parse_ssh_args(args):
+        """Return the pair (subsystem, command) of an ssh command line "[options] host [command]" (subsystem is set for "-s")."""
+        subsystem = False
+        i = 0
+        while i < len(args) and args[i].startswith('-'):
+            if args[i] == '-s':
+                subsystem = True
+            elif len(args[i]) == 2 and args[i][1] in LoopbackTransport._ssh_arg_options:
+                i += 1 # skip the argument of the option
+            i += 1
+        command = args[i + 1:]
+        if command[:1] == ['-s']:
+            subsystem = True
+            command = command[1:]
+        return subsystem, ' '.join(command)
+    
+    @staticmethod
+    def relay(args):
+        """
+        Execute an ssh command line locally and forward stdin and stdout with the given delay and bandwidth, and exit with the exit code of the command.
+        
+        args: round-trip time, bandwidth, and the ssh arguments (see LoopbackTransport._command)
+        """
+        rtt, bandwidth = float(args[0]), int(args[1])
+        subsystem, command = LoopbackTransport._parse_ssh_args(args[2:])
+        if subsystem:
+            servers = [s for s in LoopbackTransport._sftp_servers if os.path.exists(s)]
+            if command != 'sftp' or not servers:
+                sys.exit('unsupported subsystem "%s"' % command)
+            process = subprocess.Popen([servers[0]], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        else:
+            process = subprocess.Popen(['sh', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        def forward(src, dst):
+            # src and dst are file objects, which own the file descriptors (only unbuffered reads and writes use them directly)
+            chunks = queue.Queue()
+            def read():
+                while True:
+                    data = os.read(src.fileno(), 65536)
+                    chunks.put((time.perf_counter() + rtt / 2, data))
+                    if not data:
+                        break
+            threading.Thread(target=read, daemon=True).start()
+            while True:
+                arrival, data = chunks.get()
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if not data:
+                    break
+                try:
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(dst.fileno(), view):]
+                except OSError:
+                    break # the reading side was closed
+                if bandwidth:
+                    time.sleep(len(data) / bandwidth)
+            try:
+                dst.close()
+            except OSError:
+                pass # the reading side was closed
+        threading.Thread(target=forward, args=(sys.stdin.buffer, process.stdin), daemon=True).start()
+        forward(process.stdout, sys.stdout.buffer)
+        sys.exit(process.wait())
+
+
+class RemoteAgent:
+    """
+    Client of a long-lived Python process serving requests on a remote machine (see Repo._serve).
+    
+    All requests are multiplexed over stdin and stdout of a single process (usually an ssh connection),
+    so several requests (from different threads) can be in flight at the same time.
+    """
+    
+    def __init__(self, shell):
+        """
+        Start the agent process.
+        
+        shell: command prefix for executing a shell command on the remote machine (e.g., ['ssh', 'host'])
+        """
+        code = Repo._remote_code('Repo._serve()').encode()
+        command = 'LC_CTYPE=en_US.utf-8 python3 -c "import sys; exec(sys.stdin.buffer.read(%d))"' % len(code)
+        self._process = subprocess.Popen(shell + [command], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        metrics.count_subprocess()
+        self._process.stdin.write(code)
+        self._process.stdin.flush()
+        self._lock = threading.Lock()
+        self._requests = dict() # request id -> queue of responses
+        self._next_id = 0
+        self._running = True
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+    
+    def _send(self, method, args):
+        data = pickle.dumps((method, args))
+        with self._lock:
+            if not self._running:
+                raise Exception('remote agent is not running')
+            request_id = self._next_id
+            self._next_id += 1
+            responses = self._requests[request_id] = queue.Queue()
+            try:
+                self._process.stdin.write(struct.pack('>IBI', request_id, 0, len(data)) + data)
+                self._process.stdin.flush()
+            except OSError:
+                del self._requests[request_id]
+                raise Exception('remote agent is not running')
+        return responses
+    
+    def _read(self):
+        stdout = self._process.stdout
+        while True:
+            header = stdout.read(9)
+            if len(header) < 9:
+                break
+            request_id, flags, size = struct.unpack('>IBI', header)
+            payload = pickle.loads(stdout.read(size))
+            with self._lock:
+                responses = self._requests[request_id]
+                if flags != 1:
+                    del self._requests[request_id]
+            responses.put((flags, payload))
+        # the agent terminated, so all pending requests fail
+        with self._lock:
+            self._running = False
+            for responses in self._requests.values():
+                responses.put((2, 'remote agent terminated'))
+            self._requests.clear()
+    
+    def call(self, method, *args):
+        """Execute "Repo._remote_<method>" with the given arguments on the remote side and return its result."""
+        with metrics.span(method, 'remote'):
+            responses = self._send(method, args)
+            while True:
+                flags, payload = responses.get()
+                if flags == 0:
+                    return payload
+                elif flags == 2:
+                    raise Exception('remote call "%s" failed (%s)' % (method, payload))
+    
+    def stream(self, method, *args):
+        """Execute "Repo._remote_<method>" (a generator) on the remote side and yield its items as they arrive."""
+        responses = self._send(method, args)
+        while True:
+            flags, payload = responses.get()
+            if flags == 1:
+                yield payload
+            elif flags == 2:
+                raise Exception('remote call "%s" failed (%s)' % (method, payload))
+            else:
+                return
+    
+    def close(self):
+        """Stop the agent process and wait until it terminates."""
+        with self._lock:
+            self._running = False
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+        self._process.wait()
+        self._reader.join()
+        self._process.stdout.close()
+
+
+class NameCodec:
+    """
+    Encode and decode file names of an encfs directory with encfsctl processes that are kept running.
+    
+    Names are passed line by line to one process per direction, so the key is derived only once per session.
+    Large batches of names are split among a pool of additional processes instead.
+    """
+    
+    def __init__(self, key, encfs_dir, *, pool_threshold=10000, pool_size=None):
+        """
+        Create the codec (processes are started on first use).
+        
+        key: encryption key
+        encfs_dir: encrypted directory containing the encfs configuration
+        pool_threshold: minimum number of names for using a pool of processes (default is 10000)
+        pool_size: number of processes in the pool (default is the number of processors)
+        """
+        self.key = key
+        self.encfs_dir = encfs_dir
+        self.pool_threshold = pool_threshold
+        self.pool_size = pool_size or os.cpu_count() or 1
+        self._processes = dict() # command -> running process
+        self._locks = {'encode': threading.Lock(), 'decode': threading.Lock()}
+        # output of encfsctl must be line-buffered for passing names one by one
+        self._line_buffered = shutil.which('stdbuf') is not None
+    
+    def _args(self, command):
+        return ['encfsctl', command, '--extpass=echo %s' % self.key, self.encfs_dir]
+    
+    def _map_batch(self, command, names):
+        process_input = '\n'.join(names)
+        _, output = execute(self._args(command), process_input=process_input, return_stdout=True)
+        return str(output, 'utf_8').split('\n')[:len(names)]
+    
+    def map(self, command, names):
+        """Return the names encoded or decoded by encfsctl (command is "encode" or "decode")."""
+        if not names:
+            return []
+        if len(names) >= self.pool_threshold and self.pool_size > 1:
+            chunk_size = -(-len(names) // self.pool_size)
+            chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+            with futures.ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+                return [m for mapped in executor.map(lambda c: self._map_batch(command, c), chunks) for m in mapped]
+        if not self._line_buffered:
+            return self._map_batch(command, names)
+        with self._locks[command]:
+            process = self._processes.get(command)
+            if process is None or process.poll() is not None:
+                process = self._processes[command] = subprocess.Popen(['stdbuf', '-oL'] + self._args(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                metrics.count_subprocess()
+            def write():
+                try:
+                    process.stdin.write(''.join(n + '\n' for n in names).encode())
+                    process.stdin.flush()
+                except OSError:
+                    pass
+            # write from a separate thread so that large batches can not block on full pipes
+            writer = threading.Thread(target=write, daemon=True)
+            writer.start()
+            mapped = []
+            for _ in names:
+                line = process.stdout.readline()
+                if not line:
+                    break
+                mapped.append(str(line, 'utf_8').rstrip('\n'))
+            writer.join()
+            if len(mapped) < len(names):
+                del self._processes[command]
+                raise Exception('encfsctl %s terminated unexpectedly' % command)
+            return mapped
+    
+    def close(self):
+        """Stop all running processes."""
+        for command, process in self._processes.items():
+            with self._locks[command]:
+                try:
+                    process.stdin.close()
+                    process.wait()
+                except OSError:
+                    # the process terminated before all buffered names were written (broken pipe)
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+        self._processes.clear()
+
+
+class EncfsCodec:
+    """
+    In-process implementation of the encfs file name encoding (AES with block name encoding).
+    
+    The parameters are read from the ".encfs6.xml" configuration of the encrypted directory.
+    AES is provided by the "cryptography" package if it is installed and by a (slower) pure Python implementation otherwise.
+    Names are encoded like "encfsctl encode" encodes single path components.
+    """
+    
+    _alphabet = ',-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    _alphabet_index = {c: i for i, c in enumerate(_alphabet)}
+    _tables = None # lookup tables of the pure Python AES implementation (computed on first use)
+    
+    def __init__(self, key, config_file):
+        """
+        Read the encfs configuration and decrypt the volume key.
+        
+        key: encryption key
+        config_file: path of the ".encfs6.xml" file
+        Raises an exception if the configuration is not supported or the key is wrong.
+        """
+        root = xml.etree.ElementTree.parse(config_file).getroot()
+        cfg = root if root.tag == 'cfg' else root.find('cfg')
+        def value(name):
+            element = cfg.find(name)
+            if element is None or element.text is None:
+                raise Exception('missing option %s in %s' % (name, config_file))
+            return element.text.strip()
+        def data(name):
+            text = ''.join(value(name).split())
+            return base64.b64decode(text + '=' * (-len(text) % 4))
+        if value('cipherAlg/name') != 'ssl/aes' or int(value('cipherAlg/major')) < 3:
+            raise Exception('unsupported cipher %s %s' % (value('cipherAlg/name'), value('cipherAlg/major')))
+        if value('nameAlg/name') != 'nameio/block':
+            raise Exception('unsupported name encoding %s' % value('nameAlg/name'))
+        self.key_size = int(value('keySize')) // 8
+        if self.key_size not in (16, 24, 32):
+            raise Exception('unsupported key size %d' % (self.key_size * 8))
+        iterations = int(value('kdfIterations'))
+        if iterations <= 0:
+            raise Exception('unsupported key derivation')
+        self.chained_iv = value('chainedNameIV') == '1'
+        # derive the user key and decrypt the volume key with it
+        user_key = hashlib.pbkdf2_hmac('sha1', key.encode(), data('saltData'), iterations, self.key_size + 16)
+        encoded_key = data('encodedKeyData')
+        if len(encoded_key) != 4 + self.key_size + 16:
+            raise Exception('invalid key data in %s' % config_file)
+        self._set_key(user_key)
+        checksum = int.from_bytes(encoded_key[:4], 'big')
+        volume_key = self._stream_decode(encoded_key[4:], checksum)
+        if self._mac(volume_key, 32) != checksum:
+            raise Exception('wrong key for %s' % config_file)
+        self._set_key(volume_key)
+    
+    @staticmethod
+    def load(key, encfs_dir):
+        """Return a codec for an encrypted directory or None if its configuration is not supported."""
+        try:
+            return EncfsCodec(key, os.path.join(encfs_dir, '.encfs6.xml'))
+        except Exception:
+            return None
+    
+    def _set_key(self, key_data):
+        self._key = key_data[:self.key_size]
+        self._iv_data = key_data[self.key_size:]
+        self._hmac = hmac.new(self._key, digestmod='sha1')
+        if Cipher is None:
+            self._round_keys = EncfsCodec._expand_key(self._key)
+    
+    def _mac(self, data, bits, chained_iv=None):
+        """Return the 64, 32, or 16 bit MAC of data (encfs folds the 20 byte HMAC-SHA1)."""
+        h = self._hmac.copy()
+        h.update(data)
+        if chained_iv is not None:
+            h.update(struct.pack('<Q', chained_iv))
+        md = h.digest()
+        folded = bytearray(8)
+        for i in range(len(md) - 1):
+            folded[i % 8] ^= md[i]
+        mac = int.from_bytes(folded, 'big')
+        if bits <= 32:
+            mac = (mac >> 32) ^ (mac & 0xffffffff)
+        if bits <= 16:
+            mac = (mac >> 16) ^ (mac & 0xffff)
+        return mac
+    
+    def _iv(self, seed):
+        h = self._hmac.copy()
+        h.update(self._iv_data)
+        h.update(struct.pack('<Q', seed & 0xffffffffffffffff))
+        return h.digest()[:16]
+    
+    def _stream_decode(self, data, seed):
+        data = self._unshuffle(self._cfb(self._iv(seed + 1), data, False))
+        data = self._flip(data)
+        return self._unshuffle(self._cfb(self._iv(seed), data, False))
+    
+    def _stream_encode(self, data, seed):
+        data = self._cfb(self._iv(seed), self._shuffle(data), True)
+        data = self._flip(data)
+        return self._cfb(self._iv(seed + 1), self._shuffle(data), True)
+    
+    @staticmethod
+    def _flip(data):
+        """Reverse the bytes of every 64 byte chunk."""
+        return b''.join(bytes(reversed(data[i:i + 64])) for i in range(0, len(data), 64))
+    
+    @staticmethod
+    def _shuffle(data):
+        data = bytearray(data)
+        for i in range(1, len(data)):
+            data[i] ^= data[i - 1]
+        return bytes(data)
+    
+    @staticmethod
+    def _unshuffle(data):
+        return bytes([data[0]] + [data[i] ^ data[i - 1] for i in range(1, len(data))]) if data else data
+    
+    def encode_name(self, name):
+        """Return the encrypted name of a single path component."""
+        if name in ('', '.', '..'):
+            return name
+        data = name.encode('utf_8', 'surrogateescape')
+        padding = 16 - len(data) % 16
+        data += bytes([padding]) * padding
+        mac = self._mac(data, 16, 0 if self.chained_iv else None)
+        data = struct.pack('>H', mac) + self._cbc(self._iv(mac), data, True)
+        value = int.from_bytes(data, 'little')
+        return ''.join(EncfsCodec._alphabet[(value >> 6 * i) & 63] for i in range((len(data) * 8 + 5) // 6))
+    
+    def decode_name(self, name):
+        """Return the clear name of a single encrypted path component or None if it can not be decoded (invalid characters, length, padding, or MAC)."""
+        if name in ('', '.', '..'):
+            return name
+        try:
+            value = sum(EncfsCodec._alphabet_index[c] << 6 * i for i, c in enumerate(name))
+        except KeyError:
+            return None
+        length = len(name) * 6 // 8
+        data = (value & ((1 << 8 * length) - 1)).to_bytes(length, 'little')
+        if len(data) - 2 < 16 or (len(data) - 2) % 16:
+            return None
+        mac = int.from_bytes(data[:2], 'big')
+        data = self._cbc(self._iv(mac), data[2:], False)
+        padding = data[-1]
+        if padding == 0 or padding > 16 or self._mac(data, 16, 0 if self.chained_iv else None) != mac:
+            return None
+        return data[:-padding].decode('utf_8', 'surrogateescape')
+    
+    def map(self, command, names):
+        """Return the encoded or decoded names (command is "encode" or "decode", see NameCodec.map)."""
+        if command == 'encode':
+            return [self.encode_name(n) for n in names]
+        return [self.decode_name(n) for n in names]
+    
+    def close(self):
+        """Nothing to release (see NameCodec.close)."""
+    
+    def _cfb(self, iv, data, encrypt):
+        """AES in CFB mode with 128 bit feedback."""
+        if Cipher is not None:
+            cipher = Cipher(algorithms.AES(self._key), modes.CFB(iv))
+            context = cipher.encryptor() if encrypt else cipher.decryptor()
+            return context.update(data) + context.finalize()
+        output = bytearray()
+        for i in range(0, len(data), 16):
+            block = data[i:i + 16]
+            stream = EncfsCodec._encrypt_block(self._round_keys, iv)
+            out = bytes(a ^ b for a, b in zip(block, stream))
+            output += out
+            iv = out if encrypt else block
+        return bytes(output)
+    
+    def _cbc(self, iv, data, encrypt):
+        """AES in CBC mode without padding."""
+        if Cipher is not None:
+            cipher = Cipher(algorithms.AES(self._key), modes.CBC(iv))
+            context = cipher.encryptor() if encrypt else cipher.decryptor()
+            return context.update(data) + context.finalize()
+        output = bytearray()
+        for i in range(0, len(data), 16):
+            block = data[i:i + 16]
+            if encrypt:
+                iv = EncfsCodec._encrypt_block(self._round_keys, bytes(a ^ b for a, b in zip(block, iv)))
+                output += iv
+            else:
+                output += bytes(a ^ b for a, b in zip(EncfsCodec._decrypt_block(self._round_keys, block), iv))
+                iv = block
+        return bytes(output)
+    
+    @staticmethod
+    def _aes_tables():
+        if EncfsCodec._tables is None:
+            def mul(a, b):
+                p = 0
+                while b:
+                    if b & 1:
+                        p ^= a
+                    a = ((a << 1) ^ 0x11b) if a & 0x80 else a << 1
+                    b >>= 1
+                return p
+            sbox = [0] * 256
+            inv_sbox = [0] * 256
+            for x in range(256):
+                inverse = 0 if x == 0 else next(y for y in range(1, 256) if mul(x, y) == 1)
+                s = inverse
+                for shift in range(1, 5):
+                    s ^= ((inverse << shift) | (inverse >> (8 - shift))) & 0xff
+                sbox[x] = s ^ 0x63
+                inv_sbox[s ^ 0x63] = x
+            def rotations(words):
+                tables = [words]
+                for _ in range(3):
+                    tables.append([(w >> 8) | ((w & 0xff) << 24) for w in tables[-1]])
+                return tables
+            te = rotations([mul(s, 2) << 24 | s << 16 | s << 8 | mul(s, 3) for s in sbox])
+            td = rotations([mul(s, 14) << 24 | mul(s, 9) << 16 | mul(s, 13) << 8 | mul(s, 11) for s in inv_sbox])
+            EncfsCodec._tables = sbox, inv_sbox, te, td
+        return EncfsCodec._tables
+    
+    @staticmethod
+    def _expand_key(key):
+        """Return the round keys for encryption and decryption."""
+        sbox, _, _, td = EncfsCodec._aes_tables()
+        nk = len(key) // 4
+        rounds = nk + 6
+        words = list(struct.unpack('>%dI' % nk, key))
+        rcon = 1
+        for i in range(nk, 4 * (rounds + 1)):
+            w = words[-1]
+            if i % nk == 0:
+                w = (sbox[(w >> 16) & 0xff] << 24 | sbox[(w >> 8) & 0xff] << 16 | sbox[w & 0xff] << 8 | sbox[w >> 24]) ^ (rcon << 24)
+                rcon = (rcon << 1) ^ (0x11b if rcon & 0x80 else 0)
+            elif nk > 6 and i % nk == 4:
+                w = sbox[w >> 24] << 24 | sbox[(w >> 16) & 0xff] << 16 | sbox[(w >> 8) & 0xff] << 8 | sbox[w & 0xff]
+            words.append(words[i - nk] ^ w)
+        encrypt_keys = [words[4 * r:4 * r + 4] for r in range(rounds + 1)]
+        decrypt_keys = [encrypt_keys[rounds]]
+        for r in range(rounds - 1, 0, -1):
+            decrypt_keys.append([td[0][sbox[w >> 24]] ^ td[1][sbox[(w >> 16) & 0xff]] ^ td[2][sbox[(w >> 8) & 0xff]] ^ td[3][sbox[w & 0xff]] for w in encrypt_keys[r]])
+        decrypt_keys.append(encrypt_keys[0])
+        return encrypt_keys, decrypt_keys
+    
+    @staticmethod
+    def _encrypt_block(round_keys, block):
+        sbox, _, (t0, t1, t2, t3), _ = EncfsCodec._aes_tables()
+        keys = round_keys[0]
+        s0, s1, s2, s3 = (w ^ k for w, k in zip(struct.unpack('>4I', block), keys[0]))
+        for k in keys[1:-1]:
+            s0, s1, s2, s3 = (t0[s0 >> 24] ^ t1[(s1 >> 16) & 0xff] ^ t2[(s2 >> 8) & 0xff] ^ t3[s3 & 0xff] ^ k[0],
+                              t0[s1 >> 24] ^ t1[(s2 >> 16) & 0xff] ^ t2[(s3 >> 8) & 0xff] ^ t3[s0 & 0xff] ^ k[1],
+                              t0[s2 >> 24] ^ t1[(s3 >> 16) & 0xff] ^ t2[(s0 >> 8) & 0xff] ^ t3[s1 & 0xff] ^ k[2],
+                              t0[s3 >> 24] ^ t1[(s0 >> 16) & 0xff] ^ t2[(s1 >> 8) & 0xff] ^ t3[s2 & 0xff] ^ k[3])
+        k = keys[-1]
+        return struct.pack('>4I',
+                           (sbox[s0 >> 24] << 24 | sbox[(s1 >> 16) & 0xff] << 16 | sbox[(s2 >> 8) & 0xff] << 8 | sbox[s3 & 0xff]) ^ k[0],
+                           (sbox[s1 >> 24] << 24 | sbox[(s2 >> 16) & 0xff] << 16 | sbox[(s3 >> 8) & 0xff] << 8 | sbox[s0 & 0xff]) ^ k[1],
+                           (sbox[s2 >> 24] << 24 | sbox[(s3 >> 16) & 0xff] << 16 | sbox[(s0 >> 8) & 0xff] << 8 | sbox[s1 & 0xff]) ^ k[2],
+                           (sbox[s3 >> 24] << 24 | sbox[(s0 >> 16) & 0xff] << 16 | sbox[(s1 >> 8) & 0xff] << 8 | sbox[s2 & 0xff]) ^ k[3])
+    
+    @staticmethod
+    def _decrypt_block(round_keys, block):
+        _, inv_sbox, _, (t0, t1, t2, t3) = EncfsCodec._aes_tables()
+        keys = round_keys[1]
+        s0, s1, s2, s3 = (w ^ k for w, k in zip(struct.unpack('>4I', block), keys[0]))
+        for k in keys[1:-1]:
+            s0, s1, s2, s3 = (t0[s0 >> 24] ^ t1[(s3 >> 16) & 0xff] ^ t2[(s2 >> 8) & 0xff] ^ t3[s1 & 0xff] ^ k[0],
+                              t0[s1 >> 24] ^ t1[(s0 >> 16) & 0xff] ^ t2[(s3 >> 8) & 0xff] ^ t3[s2 & 0xff] ^ k[1],
+                              t0[s2 >> 24] ^ t1[(s1 >> 16) & 0xff] ^ t2[(s0 >> 8) & 0xff] ^ t3[s3 & 0xff] ^ k[2],
+                              t0[s3 >> 24] ^ t1[(s2 >> 16) & 0xff] ^ t2[(s1 >> 8) & 0xff] ^ t3[s0 & 0xff] ^ k[3])
+        k = keys[-1]
+        sbox = inv_sbox
+        return struct.pack('>4I',
+                           (sbox[s0 >> 24] << 24 | sbox[(s3 >> 16) & 0xff] << 16 | sbox[(s2 >> 8) & 0xff] << 8 | sbox[s1 & 0xff]) ^ k[0],
+                           (sbox[s1 >> 24] << 24 | sbox[(s0 >> 16) & 0xff] << 16 | sbox[(s3 >> 8) & 0xff] << 8 | sbox[s2 & 0xff]) ^ k[1],
+                           (sbox[s2 >> 24] << 24 | sbox[(s1 >> 16) & 0xff] << 16 | sbox[(s0 >> 8) & 0xff] << 8 | sbox[s3 & 0xff]) ^ k[2],
+                           (sbox[s3 >> 24] << 24 | sbox[(s2 >> 16) & 0xff] << 16 | sbox[(s1 >> 8) & 0xff] << 8 | sbox[s0 & 0xff]) ^ k[3])
 
 
 class Repo:
@@ -203,7 +900,7 @@ class Repo:
     Note that parts of this class are executed on the remote side and must therefore not reference any other parts of the code.
     """
     
-    def __init__(self, source, *, preserve_links=False, exclude=None, include=None, rel_path='.'):
+    def __init__(self, source, *, preserve_links=False, exclude=None, include=None, rel_path='.', index=None, hash_cache=None, walk_workers=1):
         """
         Create a directory wrapper.
         
@@ -212,10 +909,16 @@ class Repo:
         exclude: list or string of exclude patterns (optional, in case of a string, patterns are separated by ":")
         include: list or string of include-only patterns (optional, in case of a string, patterns are separated by ":")
         rel_path: relative path within the directory, all other files are ignored (optional)
+        index: FileIndex object for reusing unchanged directory listings of a local directory (optional)
+        hash_cache: HashCache object for reusing content hashes of unchanged files in a local directory (optional)
+        walk_workers: number of directories that are listed in parallel (default is 1, more are useful for high-latency file systems like sshfs)
         """
         self.source = source
         self.rel_path = rel_path
         self.preserve_links = preserve_links
+        self.index = index
+        self.hash_cache = hash_cache
+        self.walk_workers = walk_workers
         if exclude is None:
             self.exclude = []
         elif isinstance(exclude, str):
@@ -233,67 +936,170 @@ class Repo:
         # normalize patterns (remove trailing slashes etc.)
         self.exclude = [os.path.normpath(pattern) for pattern in self.exclude if pattern] + ['/.synkrotron']
         self.include = [os.path.normpath(pattern) for pattern in self.include if pattern]
+        self._compile_patterns()
         if isinstance(self.source, str):
             self.root = source # path
         else:
             self.root = source.mount_path # remote object
     
-    def _remote_call(self, line):
+    @staticmethod
+    def _remote_code(line):
+        """Return the code of this class including all imports followed by the given line of code."""
+        code = '\n'.join([l for l in inspect.getsource(sys.modules[__name__]).split('\n') if l.startswith(('import ', 'from '))])
+        return code + '\n' + inspect.getsource(Repo) + '\n' + line
+    
+    def _remote_call(self, method, *args):
         """
-        Execute the given line of code on the remote machine and return the result.
+        Execute a method on the remote machine and return the result.
         
-        The whole class including all imports is transferred to the remote machine.
+        Calls are served by the agent process of the Remote object (see Repo._serve).
         """
-        code = '\n'.join([l for l in inspect.getsource(sys.modules[__name__]).split('\n') if l.startswith('import ')])
-        code += '\n' + inspect.getsource(Repo) + '\npickle.dump(%s, sys.stdout.buffer)' % line
-        _, output = execute(['ssh', self.source.host, 'LC_CTYPE=en_US.utf-8 python3'], process_input=code, return_stdout=True)
-        return pickle.loads(output)
+        return self.source.agent().call(method, *args)
     
     def collect(self):
-        """Generate a dictionary of all files in the directory including their sizes and modification time stamps."""
+        """Return a FileTable of all files in the directory including their sizes and modification time stamps."""
+        if not isinstance(self.source, str) and not self.source.is_local() and self.source.key:
+            return self._collect_remote()
+        return FileTable(self.iter_sorted(), ordered=True)
+    
+    def iter_sorted(self):
+        """
+        Generate pairs (path, stat) of all files in the directory sorted by path.
+        
+        Files are generated while the directory is walked, so only the listings along the current path are kept in memory.
+        Encrypted remote directories are an exception, since their names are only sorted after decryption.
+        """
         if not isinstance(self.source, str) and not self.source.is_local():
-            return dict(self._collect_remote())
+            if self.source.key:
+                yield from self._collect_remote().items()
+            else:
+                options = dict(preserve_links=self.preserve_links, exclude=self.exclude, include=self.include, rel_path=self.rel_path, walk_workers=self.walk_workers)
+                for batch in self.source.agent().stream('walk', self.source.root, options):
+                    yield from self._unpack_stats(batch)
         else:
-            return dict(self._collect_local())
+            yield from self._collect_local(ordered=True)
         
-    def _collect_local(self):
-        def info(file):
-            path = os.path.normpath(os.path.relpath(file, self.root))
-            if self.preserve_links:
-                st = os.lstat(file)
-            else:
-                st = os.stat(file)
-            file_type = None
-            if stat.S_ISDIR(st.st_mode):
-                file_type = 'd'
-            elif stat.S_ISREG(st.st_mode):
-                file_type = 'f'
+    def _collect_local(self, ordered=False, max_depth=None):
+        def info(st):
             if stat.S_ISLNK(st.st_mode):
-                file_type = 'l'
-            if file_type is None:
-                raise Exception('unknown file type')
-            return path, (file_type, st.st_size, st.st_mtime)
+                return 'l', st.st_size, st.st_mtime
+            elif stat.S_ISDIR(st.st_mode):
+                return 'd', st.st_size, st.st_mtime
+            elif stat.S_ISREG(st.st_mode):
+                return 'f', st.st_size, st.st_mtime
+            raise Exception('unknown file type')
+        def listing(dirpath, rel_dir):
+            """
+            Return a dictionary mapping all names within a directory to [is_dir, cached stat], a dictionary mapping names to DirEntry objects, and whether the listing was cached.
+            
+            DirEntry objects are only returned for directories that were listed, they are not kept in the index.
+            """
+            dir_st = None
+            if self.index is not None:
+                try:
+                    dir_st = os.stat(dirpath)
+                except OSError:
+                    return None, None, False
+                names = self.index.lookup(rel_dir, dir_st)
+                if names is not None:
+                    return names, {}, True
+            names = dict()
+            entries = dict()
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir() # same classification as os.walk
+                        except OSError:
+                            is_dir = False
+                        names[entry.name] = [is_dir, None]
+                        entries[entry.name] = entry
+            except OSError:
+                return None, None, False
+            if dir_st is not None:
+                self.index.store(rel_dir, dir_st, names)
+            return names, entries, False
+        def process(dirpath, rel_dir):
+            """Return the stats of all included files within a directory and all sub-directories that need to be walked."""
+            names, entries, cached = listing(dirpath, rel_dir)
+            if names is None:
+                return [], []
+            if self.hash_cache is not None:
+                self.hash_cache.visit(rel_dir, names)
+            prefix = '' if rel_dir == '.' else rel_dir + '/'
+            dirnames = sorted([name for name, entry in names.items() if entry[0]])
+            filenames = sorted([name for name, entry in names.items() if not entry[0]])
+            stats = []
+            for group in (dirnames, filenames):
+                ignored = set(self._ignore_files(rel_dir, group, whitelist_dirs))
+                if ignored:
+                    group[:] = [name for name in group if name not in ignored]
+                for name in group:
+                    entry = names[name]
+                    if cached and self.index.quick and entry[1] is not None:
+                        stats.append((prefix + name, entry[1][:3]))
+                        continue
+                    try:
+                        dir_entry = entries.get(name)
+                        if dir_entry is not None:
+                            st = dir_entry.stat(follow_symlinks=not self.preserve_links)
+                        else:
+                            st = stat_file(os.path.join(dirpath, name))
+                        file_stat = info(st)
+                    except:
+                        print('warning: ignoring file "%s" (unable to stat)' % os.path.normpath(os.path.join(dirpath, name)))
+                        continue
+                    if self.index is not None:
+                        self.index.update(entry, file_stat + (st.st_ino,))
+                    stats.append((prefix + name, file_stat))
+            subdirs = []
+            for name in dirnames:
+                if self.preserve_links:
+                    is_link = entries[name].is_symlink() if name in entries else os.path.islink(os.path.join(dirpath, name))
+                    if is_link:
+                        continue
+                subdirs.append((os.path.join(dirpath, name), prefix + name))
+            return stats, subdirs
+        def walk(top, executor):
+            # yield the base directory and all files in top-down order (same as os.walk) or sorted by path if "ordered" is set;
+            # with an executor, sub-directories are processed in parallel as soon as their parent directory is reached
+            def node(subdir):
+                return subdir if executor is None else executor.submit(process, *subdir)
+            def items(result, level, extra=()):
+                stats, subdirs = result
+                merged = [(path, False, file_stat) for path, file_stat in extra + tuple(stats)]
+                if max_depth is None or level < max_depth:
+                    merged.extend((subdir[1] + '/', True, node(subdir)) for subdir in subdirs) # key of a sub-tree
+                if ordered:
+                    merged.sort(key=lambda item: item[0])
+                return iter(merged)
+            def result(node):
+                return process(*node) if executor is None else node.result()
+            stack = [items(process(base, rel_base), 1, (top,))]
+            while stack:
+                for path, subtree, value in stack[-1]:
+                    if subtree:
+                        stack.append(items(result(value), len(stack) + 1))
+                        break
+                    yield path, value
+                else:
+                    stack.pop()
+        stat_file = os.lstat if self.preserve_links else os.stat
         whitelist_dirs = set() # white-listed directories; avoid re-matching files within these directories
         base = os.path.join(self.root, self.rel_path)
         if not self._include_base(whitelist_dirs):
             return
+        rel_base = os.path.normpath(self.rel_path)
         try:
-            yield info(base)
+            top = rel_base, info(stat_file(base))
         except:
             print('warning: ignoring file "%s" (unable to stat)' % os.path.normpath(base))
             return
-        for dirpath, dirnames, filenames in os.walk(base, followlinks=not self.preserve_links):
-            for names in (dirnames, filenames):
-                names.sort()
-                rel_dir = os.path.relpath(dirpath, self.root)
-                for ign in reversed(list(self._ignore_files(rel_dir, names, whitelist_dirs))):
-                    del names[bisect.bisect_left(names, ign)]
-                for name in names:
-                    try:
-                        file = os.path.join(dirpath, name)
-                        yield info(file)
-                    except:
-                        print('warning: ignoring file "%s" (unable to stat)' % os.path.normpath(file))
+        if self.walk_workers > 1:
+            with futures.ThreadPoolExecutor(max_workers=self.walk_workers) as executor:
+                yield from walk(top, executor)
+        else:
+            yield from walk(top, None)
     
     def _include_base(self, whitelist_dirs):
         base = os.path.join(self.root, self.rel_path)
@@ -309,8 +1115,8 @@ class Repo:
     
     def _collect_remote(self):
         def call(exclude, include, rel_path):
-            return self._remote_call("list(Repo('''%s''',preserve_links=%d,exclude=%s,include=%s,rel_path='''%s''')._collect_local())"
-                                      % (self.source.root, self.preserve_links, exclude, include, rel_path))
+            options = dict(preserve_links=self.preserve_links, exclude=exclude, include=include, rel_path=rel_path, walk_workers=self.walk_workers)
+            return [item for batch in self.source.agent().stream('walk', self.source.root, options) for item in self._unpack_stats(batch)]
         if self.source.key:
             # wildcards can not be applied to encrypted names, so filtering is done in two steps (first without wildcards, then with wildcards)
             exclude_fixed = [pattern for pattern in self.exclude if '*' not in pattern and '?' not in pattern] # excludes without wildcards
@@ -322,86 +1128,178 @@ class Repo:
             include_encrypted = encrypted_names[len(exclude_fixed):-1]
             exclude_encrypted.append('/.encfs6.xml')
             exclude_encrypted.append('/clear')
-            stats_encrypted = call(exclude_encrypted, include_encrypted, rel_path_encrypted)
-            paths = self.source.decrypt_names([s[0] for s in stats_encrypted])
-            stats = dict()
-            excluded = set()
+            excluded = dict() # trie of path components, where None marks an excluded path
             whitelist_dirs = set()
-            # files must be in top-down order
-            for path, stat in zip(paths, stats_encrypted):
-                skip = False
-                for e in excluded:
-                    if path.startswith(e):
-                        skip = True
+            def keep(path):
+                """Check whether a decrypted path is included (paths must be passed in top-down order)."""
+                node = excluded
+                components = path.split('/')
+                for c in components[:-1]:
+                    node = node.get(c)
+                    if node is None or None in node:
                         break
-                if skip:
-                    continue
-                for _ in self._ignore_files(os.path.dirname(path), [os.path.basename(path)], whitelist_dirs):
-                    excluded.add(path)
-                    break
-                else:
-                    stats[path] = stat[1]
-            return stats
+                if node is not None and None in node:
+                    return False # parent directory is excluded
+                for _ in self._ignore_files(os.path.dirname(path), [components[-1]], whitelist_dirs):
+                    node = excluded
+                    for c in components:
+                        node = node.setdefault(c, dict())
+                    node[None] = True
+                    return False
+                return True
+            # files are added to the table batch by batch as soon as their names are decrypted and sorted afterwards
+            table = FileTable()
+            if len(exclude_fixed) == len(self.exclude) and len(include_fixed) == len(self.include):
+                # all patterns were applied on the remote side, so the whole tree is listed at once
+                options = dict(preserve_links=self.preserve_links, exclude=exclude_encrypted, include=include_encrypted, rel_path=rel_path_encrypted, walk_workers=self.walk_workers)
+                for batch in self.source.agent().stream('walk', self.source.root, options):
+                    stats_encrypted = list(self._unpack_stats(batch))
+                    paths = self.source.decrypt_names([s[0] for s in stats_encrypted])
+                    for path, (path_encrypted, stat) in zip(paths, stats_encrypted):
+                        if path is None:
+                            print('warning: ignoring file "%s" (unable to decrypt name)' % path_encrypted)
+                        elif keep(path):
+                            table.append(path, stat)
+            else:
+                # list the tree level by level, so directories excluded by wildcards are neither listed nor decrypted
+                options = dict(preserve_links=self.preserve_links, exclude=exclude_encrypted, include=include_encrypted)
+                dirs = [rel_path_encrypted]
+                with_base = True
+                while dirs:
+                    listed = set(dirs)
+                    subdirs = []
+                    for batch in self.source.agent().stream('level', self.source.root, dirs, options, with_base):
+                        stats_encrypted = list(self._unpack_stats(batch))
+                        paths = self.source.decrypt_names([s[0] for s in stats_encrypted])
+                        for path, (path_encrypted, stat) in zip(paths, stats_encrypted):
+                            if path is None:
+                                print('warning: ignoring file "%s" (unable to decrypt name)' % path_encrypted)
+                            elif keep(path):
+                                table.append(path, stat)
+                                if stat[0] == 'd' and path_encrypted not in listed:
+                                    subdirs.append(path_encrypted)
+                    dirs = subdirs
+                    with_base = False
+            table.sort()
+            return table
         else:
             return call(self.exclude, self.include, self.rel_path)
     
+    def _compile_patterns(self):
+        """
+        Compile the exclude patterns for matching many paths efficiently.
+        
+        Fixed patterns (without wildcards) are looked up in sets, all other patterns of the same kind are combined into a single regular expression.
+        Unanchored patterns are grouped by the number of path components they are matched against.
+        """
+        def combine(patterns):
+            if not patterns:
+                return None
+            return re.compile('|'.join('(?:%s)' % fnmatch.translate(p) for p in patterns)).match
+        wildcards = re.compile(r'[*?[]')
+        self._exclude_fixed = set() # anchored patterns without wildcards
+        anchored = []
+        unanchored = dict() # number of slashes -> (patterns without wildcards, patterns with wildcards)
+        for pattern in self.exclude:
+            if pattern.startswith('/'):
+                if wildcards.search(pattern):
+                    anchored.append(pattern[1:])
+                else:
+                    self._exclude_fixed.add(pattern[1:])
+            else:
+                fixed, wild = unanchored.setdefault(pattern.count('/'), (set(), []))
+                if wildcards.search(pattern):
+                    wild.append(pattern)
+                else:
+                    fixed.add(pattern)
+        self._exclude_anchored = combine(anchored)
+        self._exclude_unanchored = [(depth, fixed, combine(wild)) for depth, (fixed, wild) in sorted(unanchored.items())]
+        self._include_matchers = dict() # path depth -> (match function, group names)
+    
+    def _include_matcher(self, path_depth):
+        """
+        Return a function for matching the include patterns against paths with the given depth (number of slashes).
+        
+        Patterns that are deeper than the path are matched partially (e.g., only "foo" of "foo/bar" is matched against "foo").
+        Each pattern forms a named group (prefix "_f" if matched fully, "_p" if matched partially) and the first matching pattern determines the matched group.
+        """
+        matcher = self._include_matchers.get(path_depth)
+        if matcher is None:
+            groups = []
+            for i, pattern in enumerate(self.include):
+                components = pattern.split('/')
+                if len(components) - 1 > path_depth:
+                    groups.append('(?P<_p%d>%s)' % (i, fnmatch.translate('/'.join(components[:path_depth + 1]))))
+                else:
+                    groups.append('(?P<_f%d>%s)' % (i, fnmatch.translate(pattern)))
+            regex = re.compile('|'.join(groups))
+            names = [name for name in regex.groupindex if name.startswith(('_f', '_p'))]
+            matcher = self._include_matchers[path_depth] = regex.match, names
+        return matcher
+    
     def _ignore_files(self, dirpath, filenames, whitelist_dirs=None):
         """Return all filenames that should be ignored based on exclude and include patterns."""
         if not self.exclude and not self.include:
             return
-        def match(path, pattern):
-            """Match a pattern against a path."""
-            if pattern.startswith('/'): # anchored: match the whole path starting from the repository root
-                if fnmatch.fnmatch(path, pattern[1:]):
-                    return True
-            else: # not anchored: only match the last component of the path
-                tmp_path, tail = os.path.split(path)
-                components = [tail]
-                for _ in range(pattern.count('/')):
-                    tmp_path, tail = os.path.split(tmp_path)
-                    components.append(tail)
-                if fnmatch.fnmatch('/'.join(reversed(components)), pattern):
-                    return True
-            return False
+        dirpath = os.path.normpath(dirpath)
         for fn in filenames:
-            path = os.path.normpath(os.path.join(dirpath, fn))
+            if '/' in fn or fn in ('', '.', '..'):
+                path = os.path.normpath(os.path.join(dirpath, fn))
+            elif dirpath == '.':
+                path = fn
+            else:
+                path = dirpath + '/' + fn
             if path == '.':
                 continue # always include the root directory
-            ignore = False
             # match excludes
-            for pattern in self.exclude:
-                if match(path, pattern):
-                    yield fn
-                    ignore = True
-                    break
-            if ignore:
-                continue
+            if self._excluded(path):
+                yield fn
             # match includes
-            if self.include:
-                ignore = True
-                if whitelist_dirs is not None:
-                    for wl in whitelist_dirs:
-                        if path.startswith(wl):
-                            ignore = False
-                            break
-                    if not ignore:
-                        continue
-                path_depth = path.count('/')
-                for pattern in self.include:
-                    # match pattern partially in case the pattern is deeper than the path
-                    # (e.g., match only with "foo" if the pattern is "foo/bar" and the path does not contain any slashes)
-                    pattern_depth = pattern.count('/')
-                    if pattern_depth > path_depth:
-                        partial_pattern = '/'.join(pattern.split('/')[:path_depth + 1])
-                    else:
-                        partial_pattern = pattern
-                    if match(path, '/' + partial_pattern): # match (anchored) pattern
-                        if whitelist_dirs is not None and partial_pattern == pattern:
-                            whitelist_dirs.add(path)
-                        ignore = False
-                        break
-                if ignore:
-                    yield fn
+            elif self.include and not self._included(path, whitelist_dirs):
+                yield fn
+    
+    def _excluded(self, path):
+        if path in self._exclude_fixed:
+            return True
+        if self._exclude_anchored is not None and self._exclude_anchored(path):
+            return True
+        components = None
+        for depth, fixed, match in self._exclude_unanchored:
+            # not anchored: only match the last components of the path (missing components are empty)
+            if depth == 0:
+                tail = path[path.rfind('/') + 1:]
+            else:
+                if components is None:
+                    components = path.split('/')
+                if depth < len(components):
+                    tail = '/'.join(components[-depth - 1:])
+                else:
+                    tail = '/' * (depth + 1 - len(components)) + path
+            if tail in fixed or (match is not None and match(tail)):
+                return True
+        return False
+    
+    def _included(self, path, whitelist_dirs):
+        if whitelist_dirs:
+            # all files within white-listed directories are included
+            if path in whitelist_dirs:
+                return True
+            i = path.find('/')
+            while i >= 0:
+                if path[:i] in whitelist_dirs:
+                    return True
+                i = path.find('/', i + 1)
+        match, names = self._include_matcher(path.count('/'))
+        m = match(path) # match (anchored) patterns
+        if m is None:
+            return False
+        if whitelist_dirs is not None:
+            name = m.lastgroup
+            if name not in names:
+                name = [n for n in names if m.group(n) is not None][0]
+            if name.startswith('_f'):
+                whitelist_dirs.add(path)
+        return True
     
     def file_hash(self, file):
         """Compute a hash of the corresponding file content."""
@@ -410,12 +1308,66 @@ class Repo:
                 file = os.path.join(self.source.root, self.source.encrypt_names([file])[0])
             else:
                 file = os.path.join(self.source.root, file)
-            return self._remote_call("Repo._file_hash('''%s''')" % file)
+            return self._remote_call('hash', file)
         else:
             if not os.path.isabs(file):
                 file = os.path.join(self.root, file)
             return Repo._file_hash(file)
     
+    def file_hashes(self, files, workers=1):
+        """
+        Compute the content hashes of several files and yield pairs (index, hash) as soon as they are available.
+        
+        workers: number of files that are hashed in parallel (default is 1)
+        For a remote directory, all files are hashed on the remote side by a single streaming request.
+        """
+        if not isinstance(self.source, str) and not self.source.is_local():
+            if self.source.key:
+                files = self.source.encrypt_names(files)
+            files = [os.path.join(self.source.root, f) for f in files]
+            yield from self.source.agent().stream('hashes', files, workers)
+        else:
+            paths = [f if os.path.isabs(f) else os.path.join(self.root, f) for f in files]
+            if self.hash_cache is None:
+                yield from Repo._file_hashes(paths, workers)
+                return
+            uncached = [] # (index, stat) of all files that must be hashed
+            for i, path in enumerate(paths):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    uncached.append((i, None)) # hashing raises the error
+                    continue
+                digest = self.hash_cache.lookup(os.path.relpath(path, self.root), st)
+                if digest is None:
+                    uncached.append((i, st))
+                else:
+                    yield i, digest
+            for j, digest in Repo._file_hashes([paths[i] for i, _ in uncached], workers):
+                i, st = uncached[j]
+                self.hash_cache.store(os.path.relpath(paths[i], self.root), st, digest)
+                yield i, digest
+    
+    @staticmethod
+    def _file_hashes(files, workers):
+        """Hash files with a bounded pool of threads and yield pairs (index, hash) in the order of completion."""
+        if workers <= 1:
+            for i, file in enumerate(files):
+                yield i, Repo._file_hash(file)
+            return
+        def file_hash(i, file):
+            return i, Repo._file_hash(file)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for i, file in enumerate(files):
+                if len(pending) >= 2 * workers:
+                    done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for f in done:
+                        yield f.result()
+                pending.add(executor.submit(file_hash, i, file))
+            for f in futures.as_completed(pending):
+                yield f.result()
+    
     @staticmethod
     def _file_hash(file):
         md5 = hashlib.md5()
@@ -426,6 +1378,607 @@ class Repo:
                     break
                 md5.update(chunk)
             return md5.hexdigest()
+    
+    @staticmethod
+    def _serve(workers=8):
+        """
+        Serve requests of a RemoteAgent until stdin is closed (executed on the remote side).
+        
+        Every frame consists of a header (request id, flags, payload size) followed by a pickled payload.
+        A request payload is a tuple (method, args) that is dispatched to the corresponding "_remote_<method>" method.
+        Response flags: 0 = result, 1 = item of a streamed result (followed by more items and a final result), 2 = error
+        """
+        stdin = sys.stdin.buffer
+        stdout = sys.stdout.buffer
+        sys.stdout = sys.stderr # keep warnings out of the protocol stream
+        lock = threading.Lock()
+        def send(request_id, flags, obj):
+            data = pickle.dumps(obj)
+            with lock:
+                stdout.write(struct.pack('>IBI', request_id, flags, len(data)) + data)
+                stdout.flush()
+        def handle(request_id, method, args):
+            try:
+                result = getattr(Repo, '_remote_' + method)(*args)
+                if inspect.isgenerator(result):
+                    for item in result:
+                        send(request_id, 1, item)
+                    result = None
+                send(request_id, 0, result)
+            except Exception as e:
+                send(request_id, 2, '%s: %s' % (type(e).__name__, e))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                header = stdin.read(9)
+                if len(header) < 9:
+                    break
+                request_id, _, size = struct.unpack('>IBI', header)
+                method, args = pickle.loads(stdin.read(size))
+                executor.submit(handle, request_id, method, args)
+    
+    @staticmethod
+    def _remote_walk(root, options, batch_size=1000, compress=True):
+        """Walk the directory in sorted order and yield the file stats in packed batches (see Repo._pack_stats)."""
+        batch = []
+        for item in Repo(root, **options)._collect_local(ordered=True):
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield Repo._pack_stats(batch, compress)
+                batch = []
+        if batch:
+            yield Repo._pack_stats(batch, compress)
+    
+    @staticmethod
+    def _remote_level(root, dirs, options, with_base=False):
+        """List the given directories (relative to root) without descending further and yield the file stats in packed batches."""
+        repo = Repo(root, **options)
+        batch = []
+        for rel_dir in dirs:
+            repo.rel_path = rel_dir
+            items = repo._collect_local(max_depth=1)
+            if not with_base:
+                next(items, None) # the directory itself was listed before
+            for item in items:
+                batch.append(item)
+                if len(batch) == 1000:
+                    yield Repo._pack_stats(batch, True)
+                    batch = []
+        if batch:
+            yield Repo._pack_stats(batch, True)
+    
+    _stat_record = struct.Struct('>HHBqd') # shared prefix length, suffix length, type, size, mtime
+    
+    @staticmethod
+    def _pack_stats(items, compress=False):
+        """
+        Pack pairs (path, stat) into a binary batch.
+        
+        Every record consists of a header (see Repo._stat_record) followed by the part of the path that is not shared with the previous path.
+        The first byte of the batch indicates whether the records are zlib compressed.
+        """
+        records = bytearray()
+        previous = b''
+        for path, (type_, size, mtime) in items:
+            path = path.encode('utf-8', 'surrogateescape')
+            shared = min(len(os.path.commonprefix([path, previous])), 65535)
+            records += Repo._stat_record.pack(shared, len(path) - shared, 'dfl'.index(type_), size, mtime)
+            records += path[shared:]
+            previous = path
+        if compress:
+            return b'\x01' + zlib.compress(bytes(records), 1)
+        return b'\x00' + bytes(records)
+    
+    @staticmethod
+    def _unpack_stats(data):
+        """Generate the pairs (path, stat) of a batch packed by Repo._pack_stats."""
+        records = zlib.decompress(data[1:]) if data[0] else memoryview(data)[1:]
+        header = Repo._stat_record
+        previous = b''
+        offset = 0
+        while offset < len(records):
+            shared, length, type_, size, mtime = header.unpack_from(records, offset)
+            offset += header.size
+            path = previous[:shared] + bytes(records[offset:offset + length])
+            offset += length
+            previous = path
+            yield path.decode('utf-8', 'surrogateescape'), ('dfl'[type_], size, mtime)
+    
+    @staticmethod
+    def _remote_read(file):
+        """Return the content of a (small) file or None if it does not exist."""
+        try:
+            with io.open(file, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    @staticmethod
+    def _remote_hash(file):
+        return Repo._file_hash(file)
+    
+    @staticmethod
+    def _remote_hashes(files, workers):
+        return Repo._file_hashes(files, workers)
+    
+    @staticmethod
+    def _remote_stat(file, preserve_links):
+        """Return the stat (type, size, mtime) of a file or None if it does not exist."""
+        try:
+            st = os.lstat(file) if preserve_links else os.stat(file)
+        except FileNotFoundError:
+            return None
+        if stat.S_ISLNK(st.st_mode):
+            return 'l', st.st_size, st.st_mtime
+        return 'd' if stat.S_ISDIR(st.st_mode) else 'f', st.st_size, st.st_mtime
+    
+    @staticmethod
+    def _remote_mkdir(path):
+        """Create a directory unless it exists."""
+        if not os.path.isdir(path):
+            os.mkdir(path)
+    
+    @staticmethod
+    def _remote_delete(root, files):
+        """Delete files and (empty) directories relative to root in the given order and return a dictionary mapping the indices of all files that could not be deleted to the error."""
+        failed = dict()
+        for i, file in enumerate(files):
+            path = os.path.join(root, file)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    os.rmdir(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                failed[i] = e.strerror or str(e)
+        return failed
+
+
+class FileTable(collections.abc.Mapping):
+    """
+    Compact read-only mapping of paths to file stats (type, size, modification time) sorted by path.
+    
+    Paths are stored as an interned parent directory id and an encoded leaf name, stats in parallel arrays,
+    which needs a fraction of the memory of a dictionary of path strings and stat tuples.
+    Entries that are not added in sorted order are sorted by an array of entry indices (see FileTable.sort).
+    Tables are returned by Repo.collect and hold the listing of an encrypted remote directory, which Diff.iterate reads entry by entry.
+    """
+    
+    _types = 'dfl'
+    
+    def __init__(self, items=(), *, ordered=False):
+        """
+        Build the table from pairs (path, stat).
+        
+        items: iterable of pairs (path, stat)
+        ordered: the pairs are already sorted by path (default is False)
+        """
+        self._dirs = [] # directory id -> directory path
+        self._dir_ids = dict() # directory path -> directory id
+        self._parents = array.array('I')
+        self._offsets = array.array('Q', [0]) # name i is stored in _names[_offsets[i]:_offsets[i + 1]]
+        self._names = bytearray()
+        self._type = array.array('B')
+        self._size = array.array('q')
+        self._mtime = array.array('d')
+        self._order = None # entry indices sorted by path (None if the entries were added in sorted order)
+        for path, stat in items:
+            self.append(path, stat)
+        if not ordered:
+            self.sort()
+    
+    def append(self, path, stat):
+        """Add a file (FileTable.sort must be called afterwards unless files are added in sorted order)."""
+        parent, _, name = path.rpartition('/')
+        dir_id = self._dir_ids.get(parent)
+        if dir_id is None:
+            dir_id = self._dir_ids[parent] = len(self._dirs)
+            self._dirs.append(parent)
+        self._parents.append(dir_id)
+        self._names += name.encode('utf-8', 'surrogateescape')
+        self._offsets.append(len(self._names))
+        self._type.append(self._types.index(stat[0]))
+        self._size.append(stat[1])
+        self._mtime.append(stat[2])
+        self._order = None
+    
+    def sort(self):
+        """
+        Sort the entries by path.
+        
+        The entries are grouped by their parent directories, which are then sorted one at a time like Repo._collect_local walks them,
+        so only the names of a single directory are decoded at the same time.
+        """
+        # group the entry indices by parent directory (counting sort)
+        starts = array.array('Q', [0]) * (len(self._dirs) + 1)
+        for dir_id in self._parents:
+            starts[dir_id + 1] += 1
+        for i in range(len(self._dirs)):
+            starts[i + 1] += starts[i]
+        grouped = array.array('I', [0]) * len(self._parents)
+        ends = array.array('Q', starts)
+        for i, dir_id in enumerate(self._parents):
+            grouped[ends[dir_id]] = i
+            ends[dir_id] += 1
+        # sub-directories of all directories including their ancestors without entries (e.g., the parents of a relative path)
+        subdirs = collections.defaultdict(list)
+        known = set(self._dirs)
+        stack = list(self._dirs)
+        while stack:
+            path = stack.pop()
+            if path:
+                parent = path.rpartition('/')[0]
+                subdirs[parent].append(path)
+                if parent not in known:
+                    known.add(parent)
+                    stack.append(parent)
+        def items(path):
+            # entries and sub-trees (keyed by their path followed by "/") of a directory in sorted order
+            dir_id = self._dir_ids.get(path)
+            merged = [] if dir_id is None else [(self._name(i), False, i) for i in grouped[starts[dir_id]:starts[dir_id + 1]]]
+            merged.extend((subdir.rpartition('/')[2] + '/', True, subdir) for subdir in subdirs.get(path, ()))
+            merged.sort(key=lambda item: item[0])
+            return iter(merged)
+        order = array.array('I')
+        stack = [items('')] if known else []
+        while stack:
+            for _, subtree, value in stack[-1]:
+                if subtree:
+                    stack.append(items(value))
+                    break
+                order.append(value)
+            else:
+                stack.pop()
+        self._order = order
+    
+    def _name(self, i):
+        return self._names[self._offsets[i]:self._offsets[i + 1]].decode('utf-8', 'surrogateescape')
+    
+    def _path(self, i):
+        parent = self._dirs[self._parents[i]]
+        return parent + '/' + self._name(i) if parent else self._name(i)
+    
+    def _stat(self, i):
+        return (self._types[self._type[i]], self._size[i], self._mtime[i])
+    
+    def _indices(self):
+        return range(len(self._parents)) if self._order is None else self._order
+    
+    def _find(self, path):
+        indices = self._indices()
+        lo, hi = 0, len(indices)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path(indices[mid]) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(indices) and self._path(indices[lo]) == path:
+            return indices[lo]
+        raise KeyError(path)
+    
+    def __getitem__(self, path):
+        return self._stat(self._find(path))
+    
+    def __len__(self):
+        return len(self._parents)
+    
+    def __iter__(self):
+        return (self._path(i) for i in self._indices())
+    
+    def items(self):
+        """Generate pairs (path, stat) sorted by path."""
+        return ((self._path(i), self._stat(i)) for i in self._indices())
+    
+    def values(self):
+        """Generate the stats sorted by path."""
+        return (self._stat(i) for i in self._indices())
+    
+    def __repr__(self):
+        return 'FileTable(%d files)' % len(self)
+    
+
+class FileIndex:
+    """
+    Persistent index of the directory listings and file stats of a local directory.
+    
+    A directory whose modification time and inode did not change since the last run is not listed again.
+    """
+    
+    def __init__(self, index_file, *, rescan=False, quick=False):
+        """
+        Load the index from disk.
+        
+        index_file: path of the index file (usually located in the ".synkrotron" directory)
+        rescan: ignore the stored index and rebuild it from scratch (default is False)
+        quick: reuse the stored file stats of unchanged directories instead of reading them again (default is False)
+        """
+        self.index_file = index_file
+        self.quick = quick
+        # directories modified shortly before the scan might be modified again within the same time stamp granularity
+        self._racy_ns = int((time.time() - 2) * 1e9)
+        self._dirs = dict() # relative directory path -> ((mtime, inode), {name: [is_dir, (type, size, mtime, inode)]})
+        self._subdirs = collections.defaultdict(set) # relative directory path -> paths of its stored sub-directories
+        self._modified = False
+        self._lock = threading.Lock() # directories may be listed in parallel
+        if not rescan:
+            try:
+                with io.open(index_file, 'rb') as f:
+                    self._dirs = pickle.load(f)
+            except:
+                self._dirs = dict()
+        for rel_dir in self._dirs:
+            self._link(rel_dir)
+    
+    def _link(self, rel_dir):
+        if rel_dir != '.':
+            self._subdirs[os.path.dirname(rel_dir) or '.'].add(rel_dir)
+    
+    def lookup(self, rel_dir, dir_stat):
+        """Return the stored listing of a directory or None if the directory has changed."""
+        entry = self._dirs.get(rel_dir)
+        if entry is None or entry[0] is None or entry[0] != (dir_stat.st_mtime_ns, dir_stat.st_ino):
+            return None
+        return entry[1]
+    
+    def store(self, rel_dir, dir_stat, names):
+        """Store a new listing (see FileIndex.lookup) of a directory and forget all sub-directories that do not exist anymore."""
+        with self._lock:
+            self._store(rel_dir, dir_stat, names)
+    
+    def _store(self, rel_dir, dir_stat, names):
+        old = self._dirs.get(rel_dir)
+        if old is not None:
+            for name, entry in old[1].items():
+                if entry[0] and not names.get(name, [False])[0]:
+                    self._forget(name if rel_dir == '.' else rel_dir + '/' + name)
+        else:
+            self._link(rel_dir)
+        if dir_stat.st_mtime_ns < self._racy_ns:
+            key = (dir_stat.st_mtime_ns, dir_stat.st_ino)
+        else:
+            key = None # never reuse this listing
+        self._dirs[rel_dir] = (key, names)
+        self._modified = True
+    
+    def update(self, entry, file_stat):
+        """Update the stored stat (type, size, mtime, inode) of a listing entry."""
+        if entry[1] != file_stat:
+            entry[1] = file_stat
+            self._modified = True
+    
+    def _forget(self, rel_dir):
+        # only the stored sub-tree is visited (directories are linked to their parents)
+        siblings = self._subdirs.get(os.path.dirname(rel_dir) or '.')
+        if siblings is not None:
+            siblings.discard(rel_dir)
+        stack = [rel_dir]
+        while stack:
+            path = stack.pop()
+            self._dirs.pop(path, None)
+            stack.extend(self._subdirs.pop(path, ()))
+    
+    def save(self):
+        """Write the index to disk if it has changed."""
+        if not self._modified:
+            return
+        tmp_file = self.index_file + '.tmp'
+        with io.open(tmp_file, 'wb') as f:
+            pickle.dump(self._dirs, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.index_file)
+        self._modified = False
+
+
+class HashCache:
+    """
+    Persistent cache of the content hashes of files within a local directory.
+    
+    A cached hash is only used if the size, modification time, and inode of the file did not change.
+    The cache is stored as a zlib-compressed sequence of fixed-size records followed by the relative file path.
+    """
+    
+    _record = struct.Struct('>HQqQ16s') # path length, size, mtime (ns), inode, md5 digest
+    
+    def __init__(self, cache_file, root):
+        """
+        Load the cache from disk.
+        
+        cache_file: path of the cache file (usually located in the ".synkrotron" directory)
+        root: directory the cached (relative) paths refer to
+        """
+        self.cache_file = cache_file
+        self.root = root
+        self._hashes = dict() # relative path -> [size, mtime, inode, digest, seen] (seen is set if the file was listed or hashed in this run)
+        self._visited = set() # relative paths of all listed directories
+        self._modified = False
+        try:
+            with io.open(cache_file, 'rb') as f:
+                data = zlib.decompress(f.read())
+            offset = 0
+            while offset < len(data):
+                length, size, mtime, inode, digest = HashCache._record.unpack_from(data, offset)
+                offset += HashCache._record.size
+                path = data[offset:offset + length].decode('utf_8', 'surrogateescape')
+                offset += length
+                self._hashes[path] = [size, mtime, inode, digest, False]
+        except (OSError, zlib.error, struct.error):
+            self._hashes = dict()
+    
+    def lookup(self, path, st):
+        """Return the cached hash of a file if its stat (os.stat_result) did not change or None otherwise."""
+        entry = self._hashes.get(path)
+        if entry is None:
+            return None
+        entry[4] = True
+        if entry[:3] != [st.st_size, st.st_mtime_ns, st.st_ino]:
+            return None
+        return entry[3].hex()
+    
+    def visit(self, rel_dir, names):
+        """Mark the hashes of all files within a listed directory as seen, so that the hashes of deleted files in it can be evicted without checking each file."""
+        self._visited.add(rel_dir)
+        prefix = '' if rel_dir == '.' else rel_dir + '/'
+        for name in names:
+            entry = self._hashes.get(prefix + name)
+            if entry is not None:
+                entry[4] = True
+    
+    def store(self, path, st, digest):
+        """Store the hash of a file with the given stat (os.stat_result) which was taken before hashing."""
+        # files modified shortly before hashing might be modified again within the same time stamp granularity
+        racy_ns = int((time.time() - 2) * 1e9)
+        if st is None or st.st_mtime_ns >= racy_ns:
+            self._hashes.pop(path, None)
+        else:
+            self._hashes[path] = [st.st_size, st.st_mtime_ns, st.st_ino, bytes.fromhex(digest), True]
+        self._modified = True
+    
+    def save(self):
+        """
+        Evict the hashes of deleted files and write the cache to disk if it has changed.
+        
+        Hashes that were not seen are evicted if their directory was listed. Otherwise, the file is only checked if other files
+        in its directory were hashed, so unrelated parts of the directory are not accessed.
+        """
+        hashed_dirs = set(os.path.dirname(p) or '.' for p, entry in self._hashes.items() if entry[4])
+        for path in [p for p, entry in self._hashes.items() if not entry[4]]:
+            dirname = os.path.dirname(path) or '.'
+            if dirname in self._visited:
+                deleted = True
+            elif dirname in hashed_dirs:
+                deleted = not os.path.lexists(os.path.join(self.root, path))
+            else:
+                continue
+            if deleted:
+                del self._hashes[path]
+                self._modified = True
+        if not self._modified:
+            return
+        records = []
+        for path, (size, mtime, inode, digest, _) in sorted(self._hashes.items()):
+            path = path.encode('utf_8', 'surrogateescape')
+            records.append(HashCache._record.pack(len(path), size, mtime, inode, digest) + path)
+        tmp_file = self.cache_file + '.tmp'
+        with io.open(tmp_file, 'wb') as f:
+            f.write(zlib.compress(b''.join(records)))
+        os.rename(tmp_file, self.cache_file)
+        self._modified = False
+
+
+class NameCache:
+    """
+    Persistent cache of the encrypted names of file name components (for both directions).
+    
+    The cache file is an append-only sequence of records (clear name, encrypted name) that is read on first use,
+    so saving only appends the entries added since then. If the number of entries is bounded,
+    the least recently used entries are evicted and the file is rewritten.
+    """
+    
+    _record = struct.Struct('>HH') # clear name length, encrypted name length
+    
+    def __init__(self, cache_file, *, max_entries=0):
+        """
+        Create the cache (the file is read lazily).
+        
+        cache_file: path of the cache file (usually located in the ".synkrotron" directory)
+        max_entries: maximum number of cached names (default is 0, i.e., unbounded)
+        """
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self._encrypted = None # clear name -> encrypted name (ordered by last use)
+        self._clear = None # encrypted name -> clear name
+        self._new = [] # entries not written to disk yet
+        self._rewrite = False
+    
+    def _load(self):
+        self._encrypted = collections.OrderedDict()
+        self._clear = dict()
+        try:
+            with io.open(self.cache_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset < len(data):
+            if offset + NameCache._record.size > len(data):
+                break
+            clear_length, encrypted_length = NameCache._record.unpack_from(data, offset)
+            offset += NameCache._record.size
+            if offset + clear_length + encrypted_length > len(data):
+                break
+            clear = data[offset:offset + clear_length].decode('utf_8', 'surrogateescape')
+            offset += clear_length
+            encrypted = data[offset:offset + encrypted_length].decode('utf_8', 'surrogateescape')
+            offset += encrypted_length
+            self._add(clear, encrypted)
+        else:
+            return
+        # truncated file (e.g., an interrupted write), so the valid records are written again
+        self._rewrite = True
+    
+    def _add(self, clear, encrypted):
+        # remove previous mappings of both names, so that lookups in either direction never return stale names
+        previous = self._encrypted.pop(clear, None)
+        if previous is not None and self._clear.get(previous) == clear:
+            del self._clear[previous]
+        previous = self._clear.pop(encrypted, None)
+        if previous is not None and self._encrypted.get(previous) == encrypted:
+            del self._encrypted[previous]
+        self._encrypted[clear] = encrypted
+        self._clear[encrypted] = clear
+        if self.max_entries and len(self._encrypted) > self.max_entries:
+            clear, encrypted = self._encrypted.popitem(last=False)
+            if self._clear.get(encrypted) == clear:
+                del self._clear[encrypted]
+            self._rewrite = True
+    
+    def encrypt(self, name):
+        """Return the encrypted name of a clear name or None if it is not cached."""
+        if self._encrypted is None:
+            self._load()
+        encrypted = self._encrypted.get(name)
+        if encrypted is not None:
+            self._encrypted.move_to_end(name)
+        return encrypted
+    
+    def decrypt(self, name):
+        """Return the clear name of an encrypted name or None if it is not cached."""
+        if self._encrypted is None:
+            self._load()
+        clear = self._clear.get(name)
+        if clear is not None:
+            self._encrypted.move_to_end(clear)
+        return clear
+    
+    def store(self, clear, encrypted):
+        """Store the mapping between a clear and an encrypted name."""
+        if self._encrypted is None:
+            self._load()
+        if self._encrypted.get(clear) != encrypted:
+            self._add(clear, encrypted)
+            self._new.append((clear, encrypted))
+    
+    def __len__(self):
+        if self._encrypted is None:
+            self._load()
+        return len(self._encrypted)
+    
+    def save(self):
+        """Append the new entries to the cache file (or rewrite it if entries were evicted)."""
+        def records(entries):
+            for clear, encrypted in entries:
+                clear = clear.encode('utf_8', 'surrogateescape')
+                encrypted = encrypted.encode('utf_8', 'surrogateescape')
+                yield NameCache._record.pack(len(clear), len(encrypted)) + clear + encrypted
+        if self._rewrite:
+            tmp_file = self.cache_file + '.tmp'
+            with io.open(tmp_file, 'wb') as f:
+                f.write(b''.join(records(self._encrypted.items())))
+            os.rename(tmp_file, self.cache_file)
+        elif self._new:
+            with io.open(self.cache_file, 'ab') as f:
+                f.write(b''.join(records(self._new)))
+        self._new = []
+        self._rewrite = False
 
 
 class DiffStatistics:
@@ -478,7 +2031,7 @@ class DiffStatistics:
 class Diff:
     """Compare and copy files between two directories."""
     
-    def __init__(self, repo_local, repo_remote, *, ignore_time=False, content=False, modify_window=0):
+    def __init__(self, repo_local, repo_remote, *, ignore_time=False, content=False, modify_window=0, hash_workers=None, hash_batch=1000, transfer_shards=1):
         """
         Create a Diff object for generating a list of all differing files.
         
@@ -487,6 +2040,9 @@ class Diff:
         ignore_time: determines whether modification times are used during the comparison (default is False)
         content: determines whether file contents are used during the comparison (default is False)
         modify_window: the maximum allowed time difference between two files in order to be considered equal (default is 0)
+        hash_workers: number of files that are hashed in parallel on each side when comparing contents (default is the number of processors)
+        hash_batch: maximum number of differing items that are held back until the contents of the files among them are compared (default is 1000)
+        transfer_shards: number of rsync processes copying files in parallel (default is 1)
         """
         if not isinstance(repo_local, Repo):
             raise TypeError()
@@ -495,9 +2051,13 @@ class Diff:
         self.ignore_time = ignore_time
         self.content = content
         self.modify_window = modify_window
+        self.hash_workers = hash_workers or os.cpu_count() or 1
+        self.hash_batch = max(hash_batch, 1)
+        self.transfer_shards = max(transfer_shards, 1)
         self.repo_local = repo_local
         self.repo_remote = repo_remote
         self.list = None
+        self._stat_pairs = dict() # file -> (local stat, remote stat) of differing files that exist on both sides
         
     def compute(self, show=False, show_verbose=False):
         """
@@ -507,28 +2067,119 @@ class Diff:
             If 'show' is set, all differing items are printed to stdout.
             If 'show_verbose' is set in addition to 'show', additional information about the cause of the detected difference is printed.
         """
+        for _ in self.iterate(show, show_verbose):
+            pass
+        return self.list
+    
+    def iterate(self, show=False, show_verbose=False):
+        """
+            Compute all differing files and yield them in sorted order as soon as they are known.
+            
+            Both directories are walked in sorted order and joined on the fly, so the file lists are never fully kept in memory.
+            Items following a file whose content still needs to be compared are held back until the comparison is done.
+            The file list is stored in 'self.list' (see compute).
+        """
         self.list = []
-        with futures.ThreadPoolExecutor(max_workers=2) as executor:
-            stats_local, stats_remote = executor.map(Repo.collect, [self.repo_local, self.repo_remote])
-        if show and show_verbose:
-            print('Comparing %d local files against %d remote files...' % (len(stats_local), len(stats_remote)))
-        for file_local, stat_local in sorted(stats_local.items()):
-            if file_local in stats_remote:
-                cmp = self._compare_stats(stat_local, stats_remote[file_local], file_local)
-                if cmp:
-                    self.list.append((file_local,) + cmp)
+        self._stat_pairs = dict()
+        pending = collections.deque() # slots of differing items in sorted order that were not yielded yet
+        candidates = [] # (slot, file, local stat, remote stat) of files that must be compared by content
+        def ready():
+            # items up to the first file whose content comparison is still pending
+            while pending and pending[0][0] is not None:
+                item = pending.popleft()[0]
+                if item:
+                    self.list.append(item)
                     if show:
-                        Diff._show_item(*self.list[-1], show_verbose=show_verbose)
-            else:
-                self.list.append((file_local, stat_local, 'push', 'remote file does not exist'))
-                if show:
-                    Diff._show_item(*self.list[-1], show_verbose=show_verbose)
-        pulls = [(f, stats_remote[f], 'pull', 'local file does not exist') for f in sorted(set(stats_remote.keys()).difference(stats_local.keys()))]
-        if show:
-            for item in pulls:
-                Diff._show_item(*item, show_verbose=show_verbose)
-        self.list.extend(pulls)
-        return self.list
+                        Diff._show_item(*item, show_verbose=show_verbose)
+                    yield item
+        def compare_contents():
+            # hash the candidates in bulk, so that the items held back by them can be yielded
+            start = time.perf_counter()
+            for i, (hash_local, hash_remote) in self._hash_candidates([c[1] for c in candidates]):
+                slot, file, stat_local, stat_remote = candidates[i]
+                cmp = self._compare_content(stat_local, stat_remote, hash_local, hash_remote)
+                slot[0] = (file,) + cmp if cmp else False
+                if cmp:
+                    self._stat_pairs[file] = (stat_local, stat_remote)
+                yield from ready()
+            metrics.add('hash', seconds=time.perf_counter() - start, files=len(candidates), size=sum(c[2][1] + c[3][1] for c in candidates), start=start)
+            del candidates[:]
+        count_local = count_remote = 0
+        iter_local = _prefetch(metrics.iterate('collect local', self.repo_local.iter_sorted()))
+        iter_remote = _prefetch(metrics.iterate('collect remote', self.repo_remote.iter_sorted()))
+        try:
+            local = next(iter_local, None)
+            remote = next(iter_remote, None)
+            while local is not None or remote is not None:
+                if remote is None or (local is not None and local[0] < remote[0]):
+                    pending.append([(local[0], local[1], 'push', 'remote file does not exist')])
+                    count_local += 1
+                    local = next(iter_local, None)
+                elif local is None or remote[0] < local[0]:
+                    pending.append([(remote[0], remote[1], 'pull', 'local file does not exist')])
+                    count_remote += 1
+                    remote = next(iter_remote, None)
+                else:
+                    cmp = self._compare_stats(local[1], remote[1])
+                    if cmp:
+                        self._stat_pairs[local[0]] = (local[1], remote[1])
+                        pending.append([(local[0],) + cmp])
+                    elif self.content and local[1][0] != 'd':
+                        slot = [None] # placeholder until the content is compared
+                        candidates.append((slot, local[0], local[1], remote[1]))
+                        pending.append(slot)
+                    # equal files are not queued, since they are never yielded
+                    count_local += 1
+                    count_remote += 1
+                    local = next(iter_local, None)
+                    remote = next(iter_remote, None)
+                yield from ready()
+                if len(pending) >= self.hash_batch:
+                    # items are only held back by content comparisons (all other items were yielded already)
+                    yield from compare_contents()
+            if candidates:
+                yield from compare_contents()
+        finally:
+            # stop the threads collecting files in case not all items were consumed
+            iter_local.close()
+            iter_remote.close()
+        if show and show_verbose:
+            print('Compared %d local files against %d remote files' % (count_local, count_remote))
+    
+    def _hash_candidates(self, files):
+        """Compute the content hashes of files on both sides and yield (index, (local hash, remote hash)) as soon as both hashes are known."""
+        remote = self.repo_remote.source
+        if not isinstance(remote, str) and not remote.is_local() and remote.key:
+            # compare encrypted contents using the reverse-mounted local directory
+            repo_local = Repo(remote.encfs_reverse, hash_cache=remote.reverse_hash_cache)
+            files_local = remote.encrypt_names(files)
+        else:
+            repo_local = self.repo_local
+            files_local = files
+        results = queue.Queue()
+        def produce(side, repo, files):
+            try:
+                for i, digest in repo.file_hashes(files, self.hash_workers):
+                    results.put((side, i, digest))
+                results.put((side, None, None))
+            except Exception as e:
+                results.put((side, None, e))
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(produce, 0, repo_local, files_local)
+            executor.submit(produce, 1, self.repo_remote, files)
+            pending = (dict(), dict()) # hashes that are only known for one side
+            finished = 0
+            while finished < 2:
+                side, i, digest = results.get()
+                if i is None:
+                    if digest is not None:
+                        raise digest
+                    finished += 1
+                elif i in pending[1 - side]:
+                    other = pending[1 - side].pop(i)
+                    yield i, (digest, other) if side == 0 else (other, digest)
+                else:
+                    pending[side][i] = digest
     
     @staticmethod
     def _show_item(file, stat, operation, verbose_info, show_verbose):
@@ -558,10 +2209,7 @@ class Diff:
             units.pop()
         return '%.1f %sB' % (round(byte_size, 1), units[-1])
     
-    def _compare_stats(self, stat_src, stat_dst, file):
-        if stat_src[0] == stat_dst[0] == 'd':
-            return None # do not compare directories
-        # compare time
+    def _compare_time(self, stat_src, stat_dst):
         diff_time = int(stat_src[2] - stat_dst[2]) # ignore fractional time information
         if abs(diff_time) < self.modify_window:
             diff_time = 0
@@ -571,6 +2219,13 @@ class Diff:
             time_cmp = stat_src, 'push', 'local file is newer'
         else:
             time_cmp = (stat_src, stat_dst), None, 'files have the same timestamp'
+        return diff_time, time_cmp
+    
+    def _compare_stats(self, stat_src, stat_dst):
+        if stat_src[0] == stat_dst[0] == 'd':
+            return None # do not compare directories
+        # compare time
+        diff_time, time_cmp = self._compare_time(stat_src, stat_dst)
         if not self.ignore_time and diff_time:
             return time_cmp
         # compare type
@@ -586,22 +2241,16 @@ class Diff:
             return (time_cmp[0], 
                     time_cmp[1] if diff_time else 'size', 
                     'files have different sizes (local: %s, remote: %s); %s' % (Diff._format_size(stat_src[1]), Diff._format_size(stat_dst[1]), time_cmp[2]))
-        # compare content
-        if self.content:
-            if not isinstance(self.repo_remote.source, str) and not self.repo_remote.source.is_local() and self.repo_remote.source.key:
-                file_encrypted = self.repo_remote.source.encrypt_names([file])[0]
-                file_local = os.path.join(self.repo_remote.source.encfs_reverse, file_encrypted)
-            else:
-                file_local = file
-            with futures.ThreadPoolExecutor(max_workers=2) as executor:
-                hash_local = executor.submit(self.repo_local.file_hash, file_local)
-                hash_remote = executor.submit(self.repo_remote.file_hash, file)
-            if hash_local.result() != hash_remote.result():
-                return (time_cmp[0], 
-                        time_cmp[1] if diff_time else 'content', 
-                        'files have different content; %s\n    local file hash:  %s\n    remote file hash: %s' % (time_cmp[2], hash_local.result(), hash_remote.result()))
         return None
     
+    def _compare_content(self, stat_src, stat_dst, hash_local, hash_remote):
+        if hash_local == hash_remote:
+            return None
+        diff_time, time_cmp = self._compare_time(stat_src, stat_dst)
+        return (time_cmp[0], 
+                time_cmp[1] if diff_time else 'content', 
+                'files have different content; %s\n    local file hash:  %s\n    remote file hash: %s' % (time_cmp[2], hash_local, hash_remote))
+    
     def pull(self, *, simulate=False, delete=False, force=False, verbose=False):
         """
         Pull differing files from the remote directory to the local directory using rsync.
@@ -658,21 +2307,25 @@ class Diff:
         """Copy files from src to dst using rsync."""
         if self.list is None:
             self.compute()
+        remote = self.repo_remote.source
+        direct = isinstance(remote, Remote) and remote.is_direct()
+        remote_root = '%s:%s/' % (remote.host, remote.root) if direct else self.repo_remote.root
         if operation == 'push':
             src = self.repo_local.root
-            dst = self.repo_remote.root
+            dst = remote_root
             rev_operation = 'pull'
         else:
-            src = self.repo_remote.root
+            src = remote_root
             dst = self.repo_local.root
             rev_operation = 'push'
         copy_list = []
         if delete or force:
             # delete: delete all files at the destination that do not exist at the source
             # force: delete destination files that are not older in order to overwrite them with the source files
-            for file, _, file_operation, file_info in reversed(self.list):
+            deletions = [] # pairs (file, is_dir) in bottom-up order
+            for file, file_stat, file_operation, file_info in reversed(self.list):
                 if file_operation == operation:
-                    copy_list.append(file)
+                    copy_list.append((file, file_stat))
                 else:
                     if not verbose:
                         verbose_info = ''
@@ -685,18 +2338,25 @@ class Diff:
                         delete_file = True
                     if force and file_operation != operation and not file_info.endswith('exist'):
                         delete_file = True
-                        copy_list.append(file)
+                        copy_list.append((file, self._side_stat(file, file_stat, 0 if operation == 'push' else 1)))
                     if delete_file:
+                        if simulate:
+                            print('deleting %s%s' % (file, verbose_info))
+                        else:
+                            deletions.append((file, self._side_stat(file, file_stat, 1 if operation == 'push' else 0)[0] == 'd', verbose_info))
+            if deletions:
+                # files are reported once the batch is done, in the same order as they are deleted
+                failed = self._delete(operation, [(file, is_dir) for file, is_dir, _ in deletions])
+                for file, _, verbose_info in deletions:
+                    if file in failed:
+                        print('unable to delete %s%s (%s)' % (file, verbose_info, failed[file]))
+                    else:
                         print('deleting %s%s' % (file, verbose_info))
-                        if not simulate:
-                            path = os.path.join(dst, file)
-                            if os.path.isdir(path):
-                                os.rmdir(path)
-                            else:
-                                os.remove(path)
-            copy_list = '\n'.join(reversed(copy_list))
+                if failed:
+                    raise Exception('%d of %d files could not be deleted' % (len(failed), len(deletions)))
+            copy_list.reverse()
         else:
-            copy_list = '\n'.join([f[0] for f in self.list if f[2] == operation])
+            copy_list = [(f[0], f[1]) for f in self.list if f[2] == operation]
         if not copy_list:
             return
         options = []
@@ -704,10 +2364,330 @@ class Diff:
             options.append('--dry-run')
         if not self.repo_local.preserve_links:
             options.append('--copy-links')
+        if direct and not delta:
+            options.extend(remote.transport.rsync_options())
         if delta:
             dst = delta
-        execute(['rsync', '-ahuR', '--files-from=-', '--progress', '--partial-dir', '.rsync-partial'] + options + ['.', dst], cwd=src, process_input=copy_list)
+        elif direct and remote.key:
+            # transfer the ciphertext directly instead of writing through encfs on top of sshfs
+            encrypted_list = list(zip(remote.encrypt_names([file for file, _ in copy_list]), [file_stat for _, file_stat in copy_list]))
+            if operation == 'push':
+                # the reverse-mounted local directory provides the ciphertext of all local files
+                reverse_mounted = os.path.ismount(remote._sync_path('encfs-reverse'))
+                if not reverse_mounted:
+                    remote.reverse_mount()
+                try:
+                    self._rsync(options, '.', dst, remote.encfs_reverse, encrypted_list)
+                finally:
+                    if not reverse_mounted:
+                        remote.reverse_umount()
+            else:
+                # stage the ciphertext locally and copy the decrypted files from there
+                staging = remote._sync_path('staging')
+                staging_clear = remote._sync_path('staging-clear')
+                mounted = False
+                try:
+                    if not os.path.exists(staging):
+                        os.mkdir(staging)
+                    self._rsync(options, src, staging, None, encrypted_list)
+                    if not simulate:
+                        if not os.path.exists(staging_clear):
+                            os.mkdir(staging_clear)
+                        env = {'ENCFS6_CONFIG': os.path.join(remote.encfs_source, '.encfs6.xml')}
+                        if execute(['encfs', '--stdinpass', staging, staging_clear], process_input=remote.key, env=env) != 0:
+                            raise Exception('unable to mount %s with encfs' % staging)
+                        mounted = True
+                        self._rsync(options, '.', dst, staging_clear, copy_list)
+                finally:
+                    # remove the staged files even if copying failed
+                    if mounted:
+                        execute(['fusermount', '-u', staging_clear])
+                    if os.path.isdir(staging_clear) and not os.path.ismount(staging_clear):
+                        os.rmdir(staging_clear)
+                    if os.path.isdir(staging):
+                        shutil.rmtree(staging)
+            return
+        if direct and operation == 'pull':
+            # rsync reads the files from the remote server directly, so paths are relative to the source argument
+            self._rsync(options, src, dst, None, copy_list)
+        else:
+            self._rsync(options, '.', dst, src, copy_list)
+    
+    def _side_stat(self, file, file_stat, index):
+        """
+        Return the local (index 0) or remote (index 1) stat of a diff item.
+        
+        An item has a single stat (of the newer file) unless both files have the same time stamp,
+        so the stats of both files are looked up for files that exist on both sides.
+        """
+        if isinstance(file_stat[0], tuple):
+            return file_stat[index]
+        stats = self._stat_pairs.get(file)
+        return file_stat if stats is None else stats[index]
+    
+    def _delete(self, operation, files, workers=16):
+        """
+        Delete files (pairs of path and whether it is a directory) at the destination in the given bottom-up order.
+        
+        Files on a remote server are deleted by a single request to the agent.
+        Otherwise, files are deleted in parallel (directories level by level after all other files).
+        Failing deletions do not stop the others; a dictionary mapping the files that could not be deleted to the error is returned.
+        """
+        metrics.add('delete', files=len(files))
+        with metrics.phase('delete'):
+            return self._run_delete(operation, files, workers)
+    
+    def _run_delete(self, operation, files, workers):
+        remote = self.repo_remote.source
+        if operation == 'push' and isinstance(remote, Remote) and not remote.is_local():
+            # files on a remote server are deleted by the agent, which is also the only way to access directories that are not mounted (see Remote.is_direct)
+            paths = [file for file, _ in files]
+            if remote.key:
+                paths = remote.encrypt_names(paths)
+            failed = remote.agent().call('delete', remote.root, paths)
+            return {files[i][0]: error for i, error in failed.items()}
+        root = self.repo_remote.root if operation == 'push' else self.repo_local.root
+        if root is None:
+            raise Exception('%s is not mounted' % remote.location)
+        def remove(i):
+            file, is_dir = files[i]
+            try:
+                if is_dir:
+                    os.rmdir(os.path.join(root, file))
+                else:
+                    os.remove(os.path.join(root, file))
+            except OSError as e:
+                return file, e.strerror or str(e)
+            return None
+        levels = collections.defaultdict(list) # depth -> indices of directories
+        for i, (file, is_dir) in enumerate(files):
+            if is_dir:
+                levels[file.count('/')].append(i)
+        failed = dict()
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            batches = [[i for i, (_, is_dir) in enumerate(files) if not is_dir]] + [levels[depth] for depth in sorted(levels, reverse=True)]
+            for batch in batches:
+                failed.update(result for result in executor.map(remove, batch) if result is not None)
+        return failed
+    
+    def _rsync(self, options, src, dst, cwd, copy_list):
+        """
+        Copy the files of copy_list (pairs of path and stat) from src to dst.
+        
+        The paths are relative to src, which is relative to cwd (if cwd is given).
+        With several transfer shards, directories are created first and files are copied by parallel rsync processes.
+        """
+        metrics.add('transfer', files=len(copy_list), size=sum(file_stat[1] for _, file_stat in copy_list if file_stat[0] == 'f'))
+        with metrics.phase('transfer'):
+            self._run_rsync(options, src, dst, cwd, copy_list)
+    
+    def _run_rsync(self, options, src, dst, cwd, copy_list):
+        args = ['rsync', '-ahuR', '--files-from=-', '--partial-dir', '.rsync-partial'] + options + [src, dst]
+        if self.transfer_shards == 1:
+            execute(args[:3] + ['--progress'] + args[3:], cwd=cwd, process_input='\n'.join([f[0] for f in copy_list]))
+            return
+        # create directories first, so that the parallel rsync processes do not race for creating them
+        dirs = [file for file, file_stat in copy_list if file_stat[0] == 'd']
+        files = [(file, file_stat[1]) for file, file_stat in copy_list if file_stat[0] != 'd']
+        if dirs:
+            exit_code = execute(args, cwd=cwd, process_input='\n'.join(dirs))
+            if exit_code != 0:
+                # all shards would fail because of missing directories
+                print('warning: rsync process creating directories failed (exit code: %d), %d files were not transferred' % (exit_code, len(files)))
+                return
+        shards = Diff._split_shards(files, self.transfer_shards)
+        if not shards:
+            return
+        total_size = sum(size for shard in shards for _, size in shard)
+        lock = threading.Lock()
+        progress = [0, 0] # finished shards, transferred size
+        def transfer(shard):
+            exit_code = execute(args, cwd=cwd, process_input='\n'.join([file for file, _ in shard]))
+            with lock:
+                progress[0] += 1
+                progress[1] += sum(size for _, size in shard)
+                print('transferred %d/%d shards (%s of %s)' % (progress[0], len(shards), Diff._format_size(progress[1]), Diff._format_size(total_size)))
+            return exit_code
+        with futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            exit_codes = list(executor.map(transfer, shards))
+        failed = [exit_code for exit_code in exit_codes if exit_code != 0]
+        if failed:
+            print('warning: %d of %d rsync processes failed (exit codes: %s)' % (len(failed), len(shards), ', '.join(str(c) for c in failed)))
+    
+    @staticmethod
+    def _split_shards(files, count):
+        """
+        Split pairs (file, size) into at most count shards of similar total size.
+        
+        Files are assigned largest first to the shard with the smallest total size, and each shard keeps the original order of its files.
+        """
+        heap = [(0, i) for i in range(min(count, len(files)))]
+        assignment = [[] for _ in heap]
+        for index in sorted(range(len(files)), key=lambda i: -files[i][1]):
+            size, shard = heapq.heappop(heap)
+            assignment[shard].append(index)
+            heapq.heappush(heap, (size + files[index][1], shard))
+        return [[files[i] for i in sorted(indices)] for indices in assignment if indices]
+    
+
+class Watcher:
+    """
+    Watch a local directory for changes using Linux inotify.
+    
+    Changes are collected until no further changes occur for a while, so that bursts of changes (e.g., unpacking an archive) are handled at once.
+    """
+    
+    # inotify flags (see <sys/inotify.h>)
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    IN_ISDIR = 0x40000000
+    
+    _event = struct.Struct('iIII') # watch descriptor, mask, cookie, name length
+    # files modified in place are reported when they are closed (IN_CLOSE_WRITE) or, if they are kept open, when they are written (IN_MODIFY)
+    _mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+    
+    def __init__(self, repo):
+        """
+        Start watching all directories of a local Repo object (within its relative path) that are not ignored by its exclude and include patterns.
+        
+        Raises an exception if inotify is not available.
+        """
+        self.repo = repo
+        self.overflow = False # set if events were lost, so all files must be compared
+        self._dirs = dict() # watch descriptor -> directory path
+        self._whitelist_dirs = set() # directories matched fully by the include patterns
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise Exception('inotify is not available')
+        self._inotify_add_watch = libc.inotify_add_watch
+        self._inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._inotify_rm_watch = libc.inotify_rm_watch
+        self._inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise Exception('inotify is not available (%s)' % os.strerror(ctypes.get_errno()))
+        if not os.path.isdir(os.path.join(repo.root, repo.rel_path)):
+            raise Exception('%s is not a directory' % repo.rel_path)
+        self._watch_tree(os.path.normpath(repo.rel_path))
+    
+    def _watch_tree(self, top):
+        """Watch a directory including all sub-directories and return the paths of all files and directories below it."""
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.repo.root, top)):
+            path = os.path.normpath(os.path.relpath(dirpath, self.repo.root))
+            wd = self._inotify_add_watch(self._fd, os.fsencode(dirpath), Watcher._mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 28: # ENOSPC
+                    raise Exception('too many directories to watch (see /proc/sys/fs/inotify/max_user_watches)')
+                continue # the directory was deleted in the meantime
+            self._dirs[wd] = path
+            ignored = set(self.repo._ignore_files(path, dirnames + filenames, self._whitelist_dirs))
+            dirnames[:] = [d for d in dirnames if d not in ignored]
+            paths.extend(p for p in (fn if path == '.' else path + '/' + fn for fn in dirnames + filenames if fn not in ignored) if self._fully_included(p))
+        return paths
+    
+    def _unwatch_tree(self, top):
+        """Stop watching a directory including all sub-directories (a moved directory is watched again at its new location if it is still within the tree)."""
+        prefix = '' if top == '.' else top + '/'
+        for wd in [wd for wd, path in self._dirs.items() if path == top or path.startswith(prefix)]:
+            del self._dirs[wd]
+            self._inotify_rm_watch(self._fd, wd)
+    
+    def _fully_included(self, path):
+        """Check whether a path is matched fully by the include patterns (directories that only lead to included files are matched partially)."""
+        if not self.repo.include:
+            return True
+        whitelist_dirs = set()
+        components = path.split('/')
+        for i in range(1, len(components) + 1):
+            prefix = '/'.join(components[:i])
+            if not self.repo._included(prefix, whitelist_dirs):
+                return False
+            if prefix in whitelist_dirs:
+                return True
+        return False
+    
+    def _read(self, changed):
+        """Add the paths of all pending events to the set changed."""
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = Watcher._event.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + Watcher._event.size:offset + Watcher._event.size + length].rstrip(b'\0'))
+                offset += Watcher._event.size + length
+                if mask & Watcher.IN_Q_OVERFLOW:
+                    self.overflow = True
+                    continue
+                if mask & Watcher.IN_IGNORED:
+                    self._dirs.pop(wd, None) # the directory was deleted
+                    continue
+                dirpath = self._dirs.get(wd)
+                if dirpath is None:
+                    continue
+                if mask & Watcher.IN_MOVE_SELF:
+                    # a watched directory was moved without a move event of its parent (e.g., the top directory)
+                    self._unwatch_tree(dirpath)
+                    continue
+                if not name:
+                    continue
+                path = name if dirpath == '.' else dirpath + '/' + name
+                if mask & Watcher.IN_ISDIR and mask & Watcher.IN_MOVED_FROM:
+                    # the watches below the old location would report wrong paths
+                    self._unwatch_tree(path)
+                if any(True for _ in self.repo._ignore_files(dirpath, [name], self._whitelist_dirs)):
+                    continue
+                if self._fully_included(path):
+                    changed.add(path)
+                if mask & Watcher.IN_ISDIR and mask & (Watcher.IN_CREATE | Watcher.IN_MOVED_TO):
+                    # files might have been created before the new directory was watched
+                    changed.update(self._watch_tree(path))
+    
+    def changes(self, *, debounce=2.0, timeout=None, max_delay=60.0):
+        """
+        Wait for changes and return the set of changed paths once no further changes occurred for debounce seconds.
+        
+        timeout: maximum number of seconds to wait for the first change (optional, an empty set is returned after the timeout)
+        max_delay: maximum number of seconds to wait for the end of a burst of changes (default is 60)
+        """
+        changed = set()
+        first = None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.overflow:
+            if first is not None:
+                wait = min(debounce, first + max_delay - time.monotonic())
+            elif deadline is not None:
+                wait = deadline - time.monotonic()
+            else:
+                wait = None
+            if wait is not None and wait <= 0:
+                break
+            if not select.select([self._fd], [], [], wait)[0]:
+                break # no further changes
+            self._read(changed)
+            if changed and first is None:
+                first = time.monotonic()
+        return changed
     
+    def close(self):
+        """Stop watching."""
+        os.close(self._fd)
+        self._dirs.clear()
+
 
 class Config:
     """Find relevant paths and read the configuration file."""
@@ -715,15 +2695,22 @@ class Config:
     _defaults = {'clear': '',
                  'content': '0',
                  'delete': '0',
+                 'direct_transfer': '0',
                  'exclude': '',
                  'force': '0',
+                 'hash_cache': '0',
+                 'hash_workers': '0',
                  'ignore_time': '0',
                  'include': '',
+                 'index': '0',
                  'key': '',
                  'location': '',
                  'modify_window': '0',
                  'mount_point': '',
-                 'preserve_links': '0'}
+                 'name_cache_size': '0',
+                 'preserve_links': '0',
+                 'transfer_shards': '1',
+                 'walk_workers': '1'}
      
     def __init__(self, cwd=None):
         """
@@ -801,12 +2788,17 @@ class Config:
                                   '#                   [Warning: Computing content hashes comes with a significant performance penalty.]',
                                   '#   delete:         Delete all files at the destination that do not exist at the source location if set to "1" (default is "0").',
                                   '#                   Equivalent to using the "-d" command line switch.',
+                                  '#   direct_transfer: Copy files with rsync over ssh instead of mounting the remote location with sshfs if set to "1" (default is "0").',
+                                  '#                   With encryption, the ciphertext is copied from the reverse-mounted local directory (push) or staged locally (pull).',
                                   '#   exclude:        List of file patterns (separated by ":") for excluding files from the synchronization.',
                                   '#                   Supports wildcard characters like "?" and "*".',
                                   '#                   A "/" at the beginning of a pattern means it is matched starting from the root of the location.',
                                   '#                   Trailing slashes are ignored.',
                                   '#   force:          Delete all differing files at the destination that are newer or the same age if set to "1" (default is "0").',
                                   '#                   Equivalent to using the "-f" command line switch.',
+                                  '#   hash_cache:     Keep a cache of file content hashes in ".synkrotron" if set to "1" (default is "0").',
+                                  '#                   Files are only hashed again if their size, modification time, or inode changed.',
+                                  '#   hash_workers:   Number of files hashed in parallel on each side when comparing contents (default is "0", i.e., the number of processors).',
                                   '#   preserve_links: Do not follow symbolic links during synchronization if set to "1" (default is "0").',
                                   '#   ignore_time:    Ignore modification timestamps when comparing files if set to "1" (default is "0").',
                                   '#   include:        Include only the listed files (separated by ":"), i.e., exclude all other files.',
@@ -814,10 +2806,19 @@ class Config:
                                   '#                   Therefore, leading slashes can be omitted.',
                                   '#                   If a pattern matches a directory, all files within the directory are included as well.',
                                   '#                   Note that exclude pattern take precedence over include patterns.',
+                                  '#   index:          Keep an index of all local directory listings in ".synkrotron" if set to "1" (default is "0").',
+                                  '#                   Directories that did not change since the last run are not listed again.',
+                                  '#                   Use the "--rescan" command line switch for rebuilding the index.',
                                   '#   key:            Password of arbitrary length for encrypting files at the remote location.',
                                   '#                   Equivalent to using the "-i" command line switch.',
                                   '#   modify_window:  Maximum allowed modification time difference (in seconds) for files to be considered unchanged (default is "0").',
                                   '#   mount_point:    Mount the remote location at the specified mount point instead of mounting it in the ".synkrotron" directory.',
+                                  '#   name_cache_size: Maximum number of encrypted names cached in ".synkrotron" (default is "0", i.e., unbounded).',
+                                  '#                   The least recently used names are evicted first.',
+                                  '#   transfer_shards: Number of rsync processes copying files in parallel (default is "1").',
+                                  '#                   Files are split into shards of similar total size, which speeds up transfers over high-latency mounts.',
+                                  '#   walk_workers:   Number of directories listed in parallel (default is "1").',
+                                  '#                   Values greater than 1 speed up collecting files on high-latency file systems like sshfs or NFS.',
                                   '# ',
                                   '# Example:',
                                   '# [backup]',
@@ -836,6 +2837,187 @@ class Config:
         print('Please edit ".synkrotron/config" to configure the new remote location.')
     
 
+class Metrics:
+    """
+    Collect performance metrics (wall time, number of files, and bytes) for each phase of a run.
+    
+    Optionally, spans of phases, external programs, and remote calls are recorded as trace events
+    (Chrome trace event format, which can be viewed with chrome://tracing or Perfetto).
+    """
+    
+    def __init__(self):
+        self.start = time.time()
+        self.subprocesses = 0
+        self.trace_events = None # list of trace events (None if tracing is disabled)
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._phases = collections.OrderedDict() # phase name -> [seconds, files, bytes]
+    
+    def _phase(self, name):
+        phase = self._phases.get(name)
+        if phase is None:
+            phase = self._phases[name] = [0.0, 0, 0]
+        return phase
+    
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measure the wall time of a block of code as part of the given phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, seconds=time.perf_counter() - start, start=start)
+    
+    def add(self, name, *, seconds=0.0, files=0, size=0, start=None):
+        """
+        Add time, number of files, and number of bytes to a phase.
+        
+        start: value of time.perf_counter() at the beginning of the measured time (optional, records a trace span)
+        """
+        with self._lock:
+            phase = self._phase(name)
+            phase[0] += seconds
+            phase[1] += files
+            phase[2] += size
+        if start is not None:
+            self._trace(name, 'phase', start, seconds, {'files': files, 'bytes': size} if files or size else None)
+    
+    def enable_trace(self):
+        """Start recording trace events."""
+        self.trace_events = []
+    
+    def _trace(self, name, category, start, seconds, args=None):
+        """Record a complete trace event (timestamps in microseconds)."""
+        if self.trace_events is None:
+            return
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 'ts': round((start - self._origin) * 1e6, 3), 'dur': round(seconds * 1e6, 3)}
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.trace_events.append(event)
+    
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Record the wall time of a block of code as a trace span and yield a dictionary for adding span arguments."""
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self._trace(name, category, start, time.perf_counter() - start, args)
+    
+    def iterate(self, name, items):
+        """Generate the pairs (path, stat) of items and record their number and total size as a phase (from the first item to the last)."""
+        start = time.perf_counter()
+        files = size = 0
+        try:
+            for item in items:
+                files += 1
+                if item[1][0] == 'f':
+                    size += item[1][1]
+                yield item
+        finally:
+            self.add(name, seconds=time.perf_counter() - start, files=files, size=size, start=start)
+    
+    def count_subprocess(self):
+        """Count a started external process."""
+        with self._lock:
+            self.subprocesses += 1
+    
+    def record(self, **info):
+        """Return a dictionary of all metrics (extended by info) suitable for JSON serialization."""
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        phases = collections.OrderedDict()
+        with self._lock:
+            for name, (seconds, files, size) in self._phases.items():
+                phases[name] = {'seconds': round(seconds, 6),
+                                'files': files,
+                                'bytes': size,
+                                'files_per_second': files / seconds if seconds > 0 else 0,
+                                'bytes_per_second': size / seconds if seconds > 0 else 0}
+        record = collections.OrderedDict(info)
+        record.update(start=self.start,
+                      seconds=round(time.time() - self.start, 6),
+                      phases=phases,
+                      subprocesses=self.subprocesses,
+                      peak_memory=usage.ru_maxrss * 1024, # kilobytes on Linux
+                      peak_memory_children=usage_children.ru_maxrss * 1024)
+        return record
+    
+    def show(self):
+        """Print a summary of all phases."""
+        record = self.record()
+        print('%-16s %10s %10s %12s %10s %12s' % ('phase', 'time', 'files', 'files/s', 'size', 'size/s'))
+        for name, phase in record['phases'].items():
+            print('%-16s %9.2fs %10d %12.1f %10s %10s/s' % (name, phase['seconds'], phase['files'], phase['files_per_second'],
+                                                             Diff._format_size(phase['bytes']), Diff._format_size(phase['bytes_per_second'])))
+        print('total: %.2fs, subprocesses: %d, peak memory: %s (subprocesses: %s)' % (record['seconds'], record['subprocesses'],
+                                                                                     Diff._format_size(record['peak_memory']), Diff._format_size(record['peak_memory_children'])))
+    
+    def write(self, file, **info):
+        """Append the metrics (extended by info) as a line of JSON to a file."""
+        with io.open(file, 'a') as f:
+            f.write(json.dumps(self.record(**info)) + '\n')
+    
+    def write_trace(self, file):
+        """Write the recorded trace events to a file (JSON object format of the Chrome trace event format)."""
+        with self._lock:
+            events = list(self.trace_events or [])
+        with io.open(file, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+metrics = Metrics() # metrics of the current run
+
+
+def _prefetch(iterable, size=10000, batch_size=1000):
+    """
+    Generate the items of an iterable that is consumed by a background thread (at most about "size" items ahead).
+    
+    The thread stops (and closes the iterable) once the generator is closed, even if not all items were consumed.
+    """
+    batches = queue.Queue(maxsize=max(1, size // batch_size))
+    stop = threading.Event()
+    def put(batch, error):
+        # the consumer sets stop before emptying the queue, so a single item always fits afterwards
+        if stop.is_set():
+            return False
+        batches.put((batch, error))
+        return True
+    def produce():
+        try:
+            batch = []
+            for item in iterable:
+                batch.append(item)
+                if len(batch) == batch_size:
+                    if not put(batch, None):
+                        return
+                    batch = []
+            if put(batch, None):
+                put(None, None)
+        except BaseException as e:
+            put(None, e)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            batch, error = batches.get()
+            if batch is None:
+                if error is not None:
+                    raise error
+                return
+            yield from batch
+    finally:
+        stop.set()
+        while True:
+            try:
+                batches.get_nowait() # unblock the thread
+            except queue.Empty:
+                break
+
 def execute(args, *, process_input=None, cwd=None, return_stdout=False, env=None):
     """
     Run an external program and return its exit code and, optionally, its output.
@@ -847,22 +3029,57 @@ def execute(args, *, process_input=None, cwd=None, return_stdout=False, env=None
     """
     if env:
         env.update(os.environ)
-    process = subprocess.Popen(args, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE if return_stdout else None, env=env)
-    if process_input and isinstance(process_input, str): # convert string input to bytes
-        if process_input[-1] == '\n':
-            process_input = process_input.encode()
-        else:
-            process_input = (process_input + '\n').encode()
-    stdout, _ = process.communicate(input=process_input)
+    argv = ' '.join('--extpass=***' if arg.startswith('--extpass=') else arg for arg in args) # do not trace the key
+    with metrics.span(os.path.basename(args[0]), 'subprocess', argv=argv if len(argv) <= 200 else argv[:197] + '...', cwd=cwd) as span:
+        process = subprocess.Popen(args, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE if return_stdout else None, env=env)
+        metrics.count_subprocess()
+        if process_input and isinstance(process_input, str): # convert string input to bytes
+            if process_input[-1] == '\n':
+                process_input = process_input.encode()
+            else:
+                process_input = (process_input + '\n').encode()
+        stdout, _ = process.communicate(input=process_input)
+        span.update(input_bytes=len(process_input or b''), output_bytes=len(stdout or b''), exit_code=process.returncode)
     if return_stdout:
         return process.returncode, stdout
     else:
         return process.returncode
 
+def watch(watcher, synchronize, *, debounce=2.0, reconcile=600.0, max_paths=1000, verbose=False):
+    """
+    Synchronize all files and then only the changed files whenever changes are detected, until interrupted.
+    
+    watcher: Watcher object reporting changed paths
+    synchronize: function synchronizing the given list of paths (all files if the argument is omitted)
+    debounce: number of seconds without further changes before synchronizing (default is 2)
+    reconcile: number of seconds between synchronizations of all files, which catch changes that were missed (default is 600, 0 disables them)
+    max_paths: maximum number of changed paths that are synchronized separately (default is 1000, all files are synchronized for more paths)
+    """
+    try:
+        synchronize()
+        last_reconcile = time.monotonic()
+        while True:
+            timeout = max(last_reconcile + reconcile - time.monotonic(), 0) if reconcile else None
+            paths = watcher.changes(debounce=debounce, timeout=timeout)
+            # wildcards in names would be interpreted as patterns
+            if watcher.overflow or len(paths) > max_paths or any(c in p for p in paths for c in '*?[') or (reconcile and time.monotonic() >= last_reconcile + reconcile):
+                if verbose:
+                    print('synchronizing all files')
+                watcher.overflow = False
+                synchronize()
+                last_reconcile = time.monotonic()
+            elif paths:
+                if verbose:
+                    print('synchronizing %d changed paths' % len(paths))
+                synchronize(sorted(paths))
+    finally:
+        watcher.close()
+
+
 def parse_args():
     """Parse command line arguments using argparse."""
     parser = argparse.ArgumentParser(description='Synchronize files between two directories.')
-    parser.add_argument('command', choices={'pull','push', 'mount', 'umount', 'diff', 'init'}, help='init, mount, umount, diff, pull, or push')
+    parser.add_argument('command', choices={'pull','push', 'mount', 'umount', 'diff', 'init', 'watch'}, help='init, mount, umount, diff, pull, push, or watch (push changes whenever local files change)')
     parser.add_argument('remote', help='remote name (must be defined in .synkrotron/config)')
     parser.add_argument('-p', '--path', dest='path', help='diff/pull/push only the specified file or directory')
     parser.add_argument('-u', '--umount', action='store_true', help='automatically un-mount remote location after pull or push')
@@ -873,6 +3090,14 @@ def parse_args():
     parser.add_argument('-c', '--content', action='store_true', help='compare file contents in addition to size and modification time')
     parser.add_argument('-v', '--verbose', action='store_true', help='print additional information')
     parser.add_argument('-f', '--force', action='store_true', help='overwrite destination files when source files are not newer (during pull or push)')
+    parser.add_argument('--rescan', action='store_true', help='ignore the stored file index and rebuild it')
+    parser.add_argument('--quick', action='store_true', help='only check directory modification times when using the file index (changes to file contents may go unnoticed)')
+    parser.add_argument('--debounce', type=float, default=2.0, help='seconds without further changes before pushing them (watch only, default is 2)')
+    parser.add_argument('--reconcile', type=float, default=600.0, help='seconds between pushes comparing all files, which catch missed changes (watch only, default is 600, 0 disables them)')
+    parser.add_argument('--stats', action='store_true', help='print performance metrics of each phase (mount, collect, names, hash, transfer, delete)')
+    parser.add_argument('--stats-json', dest='stats_json', metavar='FILE', help='append performance metrics as a line of JSON to FILE')
+    parser.add_argument('--trace', metavar='FILE', help='write spans of all phases, external programs, and remote calls to FILE (Chrome trace event format)')
+    parser.add_argument('--profile', metavar='FILE', help='write cProfile statistics of the main thread to FILE (see the pstats module)')
     if len(sys.argv) == 1:
         parser.print_usage()
         exit()
@@ -882,9 +3107,17 @@ def parse_args():
 
 def main():
     """The main program logic."""
+    profiler = None
+    trace_file = None
     try:
         signal.signal(signal.SIGINT, lambda signal, frame: sys.exit(0))
         args = parse_args()
+        if args.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if args.trace:
+            trace_file = args.trace
+            metrics.enable_trace()
         if args.command == 'init':
             # initialize remote location and exit
             Config.init_remote(args.remote)
@@ -894,14 +3127,18 @@ def main():
             raise Exception('unknown remote name "%s"' % args.remote)
         remote_config = config.remotes[args.remote]
         # create remote location wrapper
-        remote = Remote(args.remote, remote_config['location'], config.sync_dir, key=remote_config['key'], mount_point=remote_config['mount_point'])
+        remote = Remote(args.remote, remote_config['location'], config.sync_dir, key=remote_config['key'], mount_point=remote_config['mount_point'], cache_hashes=remote_config['hash_cache'], name_cache_size=remote_config['name_cache_size'], direct_transfer=remote_config['direct_transfer'])
         if args.command == 'umount':
             # unmount remote location and exit
             remote.umount()
             # in case delta was not unmounted in a previous run, do it now (location is irrelevant here)
             Remote(remote.name + '-delta', remote.location, remote.sync_dir, key=remote.key).umount()
             return
-        remote.mount() # mount remote location
+        with metrics.phase('mount'):
+            if args.command == 'mount' or not remote.is_direct():
+                remote.mount() # mount remote location
+            else:
+                remote.connect() # mounting is not needed for direct transfers
         if args.command == 'mount':
             # exit after mounting
             return
@@ -916,6 +3153,18 @@ def main():
         include = remote_config['include']
         modify_window = remote_config['modify_window']
         preserve_links = remote_config['preserve_links']
+        hash_workers = remote_config['hash_workers']
+        transfer_shards = remote_config['transfer_shards']
+        walk_workers = remote_config['walk_workers']
+        if remote_config['index']:
+            index_file = os.path.join(config.sync_dir, 'index-links' if preserve_links else 'index')
+            index = FileIndex(index_file, rescan=args.rescan, quick=args.quick)
+        else:
+            index = None
+        if remote_config['hash_cache'] and content:
+            hash_cache = HashCache(os.path.join(config.sync_dir, 'hashes'), config.root)
+        else:
+            hash_cache = None
         # restrict synchronization to rel_path:
         if args.path:
             if args.path[0] == '/':
@@ -933,12 +3182,10 @@ def main():
             exclude_local = exclude
         if content and remote.key:
             # reverse mount for encrypted conntent diff
-            remote.reverse_mount()
-        # create Repo objects and compute diff
-        repo_local = Repo(config.root, preserve_links=preserve_links, exclude=exclude_local, include=include, rel_path=rel_path)
-        repo_remote = Repo(remote, preserve_links=preserve_links, exclude=exclude, include=include, rel_path=rel_path)
+            with metrics.phase('mount'):
+                remote.reverse_mount()
         diff_statistics = None
-        def process_command(diff, write_delta_config):
+        def process_command(diff, delta, write_delta_config):
             nonlocal diff_statistics
             # perform the reuested operation on a diff object
             diff.compute(args.command == 'diff', args.verbose)
@@ -949,50 +3196,85 @@ def main():
                     diff_statistics += DiffStatistics(diff)
             if args.command == 'pull':
                 diff.pull(simulate=args.simulate, delete=delete, force=force, verbose=args.verbose)
-            elif args.command == 'push':
-                diff.push(simulate=args.simulate, delete=delete, force=force, verbose=args.verbose, delta=delta_path, write_delta_config=write_delta_config)
-        process_command(Diff(repo_local, repo_remote, ignore_time=ignore_time, content=content, modify_window=modify_window), True)
+            elif args.command in ('push', 'watch'):
+                diff.push(simulate=args.simulate, delete=delete, force=force, verbose=args.verbose, delta=delta, write_delta_config=write_delta_config)
+        def synchronize(paths=None):
+            # create Repo objects and compute diff (restricted to the given paths, if any)
+            if paths is None:
+                include_paths = include
+                repo_index = index
+            else:
+                include_paths = paths # paths were matched against the include patterns already
+                repo_index = None # the index is only updated by complete runs
+            repo_local = Repo(config.root, preserve_links=preserve_links, exclude=exclude_local, include=include_paths, rel_path=rel_path, index=repo_index, hash_cache=hash_cache, walk_workers=walk_workers)
+            repo_remote = Repo(remote, preserve_links=preserve_links, exclude=exclude, include=include_paths, rel_path=rel_path, walk_workers=walk_workers)
+            process_command(Diff(repo_local, repo_remote, ignore_time=ignore_time, content=content, modify_window=modify_window, hash_workers=hash_workers, transfer_shards=transfer_shards), delta_path, True)
+            if remote.key and clear_paths:
+                # store clear files in a separate directory in order to avoid name clashes with encrypted files:
+                remote_clear = remote.clear_remote()
+                clear_delta_path = delta_path
+                if clear_delta_path:
+                    clear_delta_path = os.path.join(clear_delta_path, 'clear')
+                    if not os.path.exists(clear_delta_path):
+                        os.mkdir(clear_delta_path)
+                # process unencrypted paths
+                for clear_path in clear_paths.split(':'):
+                    clear_path = os.path.normpath(clear_path) # remove trailing "/" etc.
+                    if clear_path.startswith('..'):
+                        raise Exception(print('clear option "%s" points outside of the main directory' % clear_path))
+                    if clear_path.startswith('/'):
+                        # ignore leading slashes
+                        clear_path = clear_path[1:]
+                    rel_clear_path = clear_path
+                    if rel_path != '.' and not clear_path.startswith(rel_path):
+                        if rel_path.startswith(clear_path):
+                            rel_clear_path = rel_path
+                        else:
+                            continue # omit if rel_path is outside of clear_path
+                    if args.verbose:
+                        print('processing unencrypted files at "%s"' % clear_path)
+                    repo_local_clear = Repo(config.root, preserve_links=preserve_links, exclude=exclude, include=include_paths, rel_path=rel_clear_path, index=repo_index, hash_cache=hash_cache, walk_workers=walk_workers)
+                    repo_remote_clear = Repo(remote_clear, preserve_links=preserve_links, exclude=exclude, include=include_paths, rel_path=rel_clear_path, walk_workers=walk_workers)
+                    process_command(Diff(repo_local_clear, repo_remote_clear, ignore_time=ignore_time, content=content, modify_window=modify_window, hash_workers=hash_workers, transfer_shards=transfer_shards), clear_delta_path, False)
+        if args.command == 'watch':
+            # watch all local files including unencrypted ones
+            watcher = Watcher(Repo(config.root, preserve_links=preserve_links, exclude=exclude, include=include, rel_path=rel_path))
+            try:
+                watch(watcher, synchronize, debounce=args.debounce, reconcile=args.reconcile, verbose=args.verbose)
+            except SystemExit:
+                pass # interrupted, so finish as usual
+        else:
+            synchronize()
         if content and remote.key:
             # unmount (reverse) after encrypted conntent diff
             remote.reverse_umount()
-        if remote.key and clear_paths:
-            # store clear files in a separate directory in order to avoid name clashes with encrypted files:
-            clear_root = os.path.join(remote.encfs_source, 'clear')
-            if not os.path.exists(clear_root):
-                os.mkdir(clear_root)
-            remote_clear = Remote('', clear_root, config.sync_dir)
-            remote_clear.mount() # does nothing but setting the mount path
-            if delta_path:
-                delta_path = os.path.join(delta_path, 'clear')
-                if not os.path.exists(delta_path):
-                    os.mkdir(delta_path)
-            # process unencrypted paths
-            for clear_path in clear_paths.split(':'):
-                clear_path = os.path.normpath(clear_path) # remove trailing "/" etc.
-                if clear_path.startswith('..'):
-                    raise Exception(print('clear option "%s" points outside of the main directory' % clear_path))
-                if clear_path.startswith('/'):
-                    # ignore leading slashes
-                    clear_path = clear_path[1:]
-                rel_clear_path = clear_path
-                if rel_path != '.' and not clear_path.startswith(rel_path):
-                    if rel_path.startswith(clear_path):
-                        rel_clear_path = rel_path
-                    else:
-                        continue # omit if rel_path is outside of clear_path
-                if args.verbose:
-                    print('processing unencrypted files at "%s"' % clear_path)
-                repo_local_clear = Repo(config.root, preserve_links=preserve_links, exclude=exclude, include=include, rel_path=rel_clear_path)
-                repo_remote_clear = Repo(remote_clear, preserve_links=preserve_links, exclude=exclude, include=include, rel_path=rel_clear_path)
-                process_command(Diff(repo_local_clear, repo_remote_clear, ignore_time=ignore_time, content=content, modify_window=modify_window), False)
         if args.command == 'diff':
             diff_statistics.show()
         if args.umount:
             remote.umount()
+        remote.disconnect()
         remote.save_cache()
+        if index is not None:
+            index.save()
+        if hash_cache is not None:
+            hash_cache.save()
+        if args.stats:
+            metrics.show()
+        if args.stats_json:
+            metrics.write(args.stats_json, command=args.command, remote=args.remote)
     except Exception as e:
         print('error: ' + str(e))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if trace_file:
+            metrics.write_trace(trace_file)
+            metrics.trace_events = None
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['--relay']:
+        LoopbackTransport.relay(sys.argv[2:]) # ssh stand-in (see LoopbackTransport)
+    else:
+        main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2011-2012  Thomas Reineking
+# 
+# This file is part of the synkrotron application.
+# 
+# Synkrotron is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Synkrotron is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for "synkrotron.py".
+
+Synthetic directory trees are generated in a temporary directory, and the hot paths (collecting files,
+matching patterns, computing diffs and statistics, and mapping names) are timed against a stored baseline.
+The remote code paths (listing, hashing, and transferring files) are run through a LoopbackTransport
+with the given round-trip times, which shows how they scale with the latency of the connection:
+
+    python3 synkrotron_bench.py --save-baseline    # record the baseline on this machine
+    python3 synkrotron_bench.py                    # compare against the baseline (exit code 1 for regressions)
+    python3 synkrotron_bench.py --rtt 0,10,50 remote-collect remote-hash
+"""
+
+import argparse
+import base64
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from synkrotron import Diff, DiffStatistics, LoopbackTransport, Remote, Repo
+
+
+# names of special directories and file extensions, which are matched by the default patterns
+special_dirs = ['build', 'cache', '.git']
+extensions = ['.txt', '.jpg', '.py', '.o', '.tmp', '.tar.gz', '']
+
+
+def generate_tree(root, *, files=10000, depth=4, fanout=8, special_rate=0.05, seed=0):
+    """
+    Generate a directory tree with small files and fixed modification times, and return the number of created files.
+    
+    files: number of files
+    depth: maximum depth of directories
+    fanout: number of sub-directories of each directory
+    special_rate: fraction of directories with special names (see special_dirs)
+    seed: seed of the random number generator (equal seeds generate equal trees)
+    """
+    rnd = random.Random(seed)
+    dirs = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(parent, rnd.choice(special_dirs) if rnd.random() < special_rate else 'dir%d' % i)
+                 for parent in level for i in range(fanout)]
+        level = list(collections.OrderedDict.fromkeys(level))
+        dirs.extend(level)
+        if len(dirs) >= files:
+            break
+    for d in dirs[1:]:
+        os.mkdir(os.path.join(root, d))
+    for i in range(files):
+        path = os.path.join(root, rnd.choice(dirs), 'file%d%s' % (i, rnd.choice(extensions)))
+        with io.open(path, 'wb') as f:
+            f.write(b'x' * rnd.randrange(16))
+        os.utime(path, (1e9, 1e9))
+    for d in dirs:
+        os.utime(os.path.join(root, d), (1e9, 1e9))
+    return files
+
+
+def change_tree(root, *, change_rate=0.05, seed=0):
+    """
+    Modify, delete, or add files in a directory tree, and return the number of changed files.
+    
+    change_rate: fraction of files that are changed (in equal parts modified, deleted, and added)
+    seed: seed of the random number generator
+    """
+    rnd = random.Random(seed)
+    paths = sorted(os.path.join(dirpath, fn) for dirpath, _, filenames in os.walk(root) for fn in filenames)
+    changed = rnd.sample(paths, int(len(paths) * change_rate))
+    for i, path in enumerate(changed):
+        if i % 3 == 0:
+            with io.open(path, 'ab') as f:
+                f.write(b'y')
+            os.utime(path, (2e9, 2e9))
+        elif i % 3 == 1:
+            os.remove(path)
+        else:
+            with io.open(path + '.new', 'wb') as f:
+                f.write(b'z')
+    return len(changed)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discard the output of external programs (e.g., the progress of rsync)."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, 1)
+    os.close(null)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+class StubCodec:
+    """Deterministic name codec with a cost similar to encrypting names in-process (see Remote._map_names)."""
+    
+    def map(self, command, names):
+        if command == 'encode':
+            return [base64.urlsafe_b64encode(hashlib.sha1(n.encode()).digest()[:4] + n.encode()).decode() for n in names]
+        return [base64.urlsafe_b64decode(n.encode())[4:].decode() for n in names]
+    
+    def close(self):
+        pass
+
+
+class Benchmark:
+    """Generate the trees of a benchmark run and time each hot path."""
+    
+    def __init__(self, work_dir, *, files=10000, depth=4, fanout=8, special_rate=0.05, change_rate=0.05, exclude=None, include=None, seed=0):
+        """
+        Generate a local and a remote tree in work_dir (both are equal up to the changed files).
+        
+        exclude: list of exclude patterns (optional)
+        include: list of include-only patterns (optional)
+        For all other parameters, see generate_tree and change_tree.
+        """
+        self.work_dir = work_dir
+        self.exclude = exclude or []
+        self.include = include or []
+        self.local = os.path.join(work_dir, 'local')
+        self.remote = os.path.join(work_dir, 'remote')
+        self.sync_dir = os.path.join(work_dir, 'sync')
+        for d in (self.local, self.remote, self.sync_dir):
+            os.mkdir(d)
+        for d in (self.local, self.remote):
+            generate_tree(d, files=files, depth=depth, fanout=fanout, special_rate=special_rate, seed=seed)
+        change_tree(self.remote, change_rate=change_rate, seed=seed)
+        self.listing = [(os.path.relpath(dirpath, self.local), dirnames + filenames) for dirpath, dirnames, filenames in os.walk(self.local)]
+        self.paths = [os.path.normpath(os.path.join(dirpath, fn)) for dirpath, names in self.listing for fn in names]
+        self.remote_files = sorted(os.path.relpath(os.path.join(dirpath, fn), self.remote) for dirpath, _, filenames in os.walk(self.remote) for fn in filenames)
+        self.transport = LoopbackTransport()
+        self.diff = None
+        self._transfers = 0
+    
+    def _repo(self, root):
+        return Repo(root, exclude=self.exclude, include=self.include)
+    
+    def collect(self):
+        return len(list(self._repo(self.local)._collect_local(ordered=True)))
+    
+    def ignore(self):
+        repo = self._repo(self.local)
+        for dirpath, names in self.listing:
+            for _ in repo._ignore_files(dirpath, names):
+                pass
+        return len(self.paths)
+    
+    def diff_compute(self):
+        self.diff = Diff(self._repo(self.local), self._repo(self.remote))
+        self.diff.compute()
+        return len(self.paths)
+    
+    def statistics(self):
+        if self.diff is None:
+            self.diff_compute()
+        statistics = DiffStatistics(self.diff)
+        return statistics.pull_count + statistics.push_count + statistics.rest_count
+    
+    def _remote(self):
+        remote = Remote('bench', self.local, self.sync_dir, key='bench')
+        remote.encfs_source = self.local
+        remote._name_codec = StubCodec()
+        return remote
+    
+    def names_cold(self):
+        return len(self._remote().encrypt_names(self.paths))
+    
+    def names_cached(self):
+        remote = self._remote()
+        encrypted = remote.encrypt_names(self.paths)
+        start = time.perf_counter()
+        remote.decrypt_names(encrypted)
+        return len(encrypted), time.perf_counter() - start
+    
+    def _loopback(self, root, **options):
+        return Remote('bench', 'loopback:' + root, self.sync_dir, transport=self.transport, **options)
+    
+    def remote_collect(self):
+        remote = self._loopback(self.remote)
+        try:
+            return len(list(self._repo(remote).iter_sorted()))
+        finally:
+            remote.disconnect()
+    
+    def remote_hash(self):
+        remote = self._loopback(self.remote)
+        try:
+            return len(list(self._repo(remote).file_hashes(self.remote_files, 4)))
+        finally:
+            remote.disconnect()
+    
+    def remote_transfer(self):
+        if shutil.which('rsync') is None:
+            return None # skipped
+        self._transfers += 1
+        target = os.path.join(self.work_dir, 'transfer%d' % self._transfers)
+        os.mkdir(target)
+        remote = self._loopback(target, direct_transfer=True)
+        try:
+            diff = Diff(self._repo(self.local), self._repo(remote))
+            with quiet():
+                diff.push()
+            return len(diff.list)
+        finally:
+            remote.disconnect()
+    
+    benchmarks = collections.OrderedDict([
+        ('collect', collect),
+        ('ignore', ignore),
+        ('diff', diff_compute),
+        ('statistics', statistics),
+        ('names-cold', names_cold),
+        ('names-cached', names_cached),
+    ])
+    
+    # benchmarks using the loopback transport (run once for each round-trip time)
+    remote_benchmarks = collections.OrderedDict([
+        ('remote-collect', remote_collect),
+        ('remote-hash', remote_hash),
+        ('remote-transfer', remote_transfer),
+    ])
+    
+    def run(self, name, repeat=3):
+        """Run a benchmark and return the pair (items, seconds) of its fastest run (None if the benchmark was skipped)."""
+        function = Benchmark.benchmarks.get(name) or Benchmark.remote_benchmarks[name]
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function(self)
+            seconds = time.perf_counter() - start
+            if result is None:
+                return None
+            if isinstance(result, tuple):
+                result, seconds = result # only a part of the benchmark is timed
+            if best is None or seconds < best[1]:
+                best = (result, seconds)
+        return best
+
+
+def run_benchmarks(*, names=None, repeat=3, rtts=(0,), bandwidth=0, **options):
+    """
+    Run benchmarks on generated trees and return an ordered dictionary mapping benchmark names to pairs (items, seconds).
+    
+    names: names of the benchmarks (optional, default is all benchmarks in Benchmark.benchmarks and Benchmark.remote_benchmarks)
+    repeat: number of runs of each benchmark (the fastest is reported)
+    rtts: round-trip times in seconds of the loopback transport (the names of remote benchmarks are suffixed with the round-trip time)
+    bandwidth: bandwidth of the loopback transport in bytes per second (default is 0, i.e., unlimited)
+    For all other options, see Benchmark.
+    """
+    work_dir = tempfile.mkdtemp(prefix='synkrotron-bench-')
+    try:
+        benchmark = Benchmark(work_dir, **options)
+        results = collections.OrderedDict()
+        for name in Benchmark.benchmarks:
+            if not names or name in names:
+                results[name] = benchmark.run(name, repeat)
+        for rtt in rtts:
+            benchmark.transport = LoopbackTransport(rtt=rtt, bandwidth=bandwidth)
+            for name in Benchmark.remote_benchmarks:
+                if not names or name in names:
+                    result = benchmark.run(name, repeat)
+                    if result is not None:
+                        results['%s@%gms' % (name, rtt * 1000)] = result
+        return results
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Print results next to the baseline and return the names of all benchmarks that are slower than the baseline by more than the tolerance.
+    
+    results: dictionary mapping benchmark names to pairs (items, seconds)
+    baseline: dictionary mapping benchmark names to seconds
+    tolerance: allowed relative slow-down (default is 0.2)
+    """
+    regressions = []
+    print('%-24s %10s %12s %10s %8s' % ('benchmark', 'time', 'items/s', 'baseline', 'ratio'))
+    for name, (items, seconds) in results.items():
+        line = '%-24s %9.3fs %12.0f' % (name, seconds, items / seconds if seconds > 0 else 0)
+        if name in baseline:
+            ratio = seconds / baseline[name] if baseline[name] > 0 else 1
+            line += ' %9.3fs %7.2fx' % (baseline[name], ratio)
+            if ratio > 1 + tolerance:
+                line += ' (regression)'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def parse_args(argv=None):
+    """Parse command line arguments using argparse."""
+    parser = argparse.ArgumentParser(description='Benchmark synkrotron on generated directory trees.')
+    parser.add_argument('names', nargs='*', metavar='benchmark', help='benchmarks to run (default is all: %s)' % ', '.join(list(Benchmark.benchmarks) + list(Benchmark.remote_benchmarks)))
+    parser.add_argument('--files', type=int, default=10000, help='number of files in each tree (default is 10000)')
+    parser.add_argument('--depth', type=int, default=4, help='maximum depth of directories (default is 4)')
+    parser.add_argument('--fanout', type=int, default=8, help='number of sub-directories of each directory (default is 8)')
+    parser.add_argument('--special-rate', dest='special_rate', type=float, default=0.05, help='fraction of directories named %s (default is 0.05)' % ', '.join(special_dirs))
+    parser.add_argument('--change-rate', dest='change_rate', type=float, default=0.05, help='fraction of files that differ between local and remote tree (default is 0.05)')
+    parser.add_argument('--exclude', default='*.o:*.tmp:/build:cache/*:.git', help='exclude patterns separated by ":" (default is "*.o:*.tmp:/build:cache/*:.git")')
+    parser.add_argument('--include', default='', help='include-only patterns separated by ":" (optional)')
+    parser.add_argument('--rtt', default='0', help='round-trip times in milliseconds of the loopback transport for remote benchmarks, separated by "," (default is 0)')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bandwidth of the loopback transport in bytes per second (default is 0, i.e., unlimited)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generating the trees')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each benchmark, the fastest is reported (default is 3)')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synkrotron_bench.json'), help='baseline file (default is "synkrotron_bench.json" next to this script)')
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slow-down compared to the baseline (default is 0.2)')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in Benchmark.benchmarks and name not in Benchmark.remote_benchmarks]
+    if unknown:
+        parser.error('unknown benchmark "%s"' % unknown[0])
+    return args
+
+
+def main(argv=None):
+    """Run the benchmarks and return the exit code (1 if a benchmark is slower than the baseline)."""
+    args = parse_args(argv)
+    options = dict(files=args.files, depth=args.depth, fanout=args.fanout, special_rate=args.special_rate, change_rate=args.change_rate,
+                   exclude=[p for p in args.exclude.split(':') if p], include=[p for p in args.include.split(':') if p], seed=args.seed)
+    results = run_benchmarks(names=args.names, repeat=args.repeat, rtts=[float(rtt) / 1000 for rtt in args.rtt.split(',')], bandwidth=args.bandwidth, **options)
+    # baselines are only comparable for equal options
+    key = json.dumps(dict(options, bandwidth=args.bandwidth), sort_keys=True)
+    baselines = dict()
+    if os.path.exists(args.baseline):
+        with io.open(args.baseline) as f:
+            baselines = json.load(f)
+    regressions = compare(results, baselines.get(key, {}), args.tolerance)
+    if args.save_baseline:
+        baseline = baselines.setdefault(key, {})
+        baseline.update((name, seconds) for name, (_, seconds) in results.items())
+        with io.open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print('saved baseline to "%s"' % args.baseline)
+    elif regressions:
+        print('regressions: %s' % ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
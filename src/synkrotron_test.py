@@ -19,15 +19,22 @@
 Unit tests for "synkrotron.py".
 """
 
+import base64
 import configparser
+import hashlib
 import io
+import json
 import synkrotron
-from synkrotron import Config, Diff, DiffStatistics, Remote, Repo
+import synkrotron_bench
+from synkrotron import Config, Diff, DiffStatistics, EncfsCodec, FileIndex, FileTable, HashCache, LoopbackTransport, Metrics, NameCache, NameCodec, Remote, RemoteAgent, Repo, Watcher
+from concurrent import futures
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
 
@@ -136,6 +143,44 @@ class TestDiff(TestSynkrotron):
         diff = Diff(Repo(self.local1_base), Repo(self.local2_base), content=True)
         self.assertEqual((('dir/file_ä', 'content'),), self._filter(diff))
     
+    def test_diff_content_many(self):
+        for base in (self.local1_base, self.local2_base):
+            for i in range(20):
+                with io.open(os.path.join(base, 'file%02d' % i), 'w') as f:
+                    f.write('content' if base == self.local2_base or i % 3 else 'xontent')
+        os.mkdir(os.path.join(self.local1_base, 'new'))
+        self._fix_mtime(self.local1_base)
+        self._fix_mtime(self.local2_base)
+        expected = tuple(('file%02d' % i, 'content') for i in range(0, 20, 3)) + (('new', 'push'),)
+        for hash_workers in (1, 4):
+            diff = Diff(Repo(self.local1_base), Repo(self.local2_base), content=True, hash_workers=hash_workers)
+            self.assertEqual(expected, self._filter(diff))
+        # contents are compared in batches, so items are yielded before all files are hashed
+        diff = Diff(Repo(self.local1_base), Repo(self.local2_base), content=True, hash_batch=4)
+        batches = []
+        hash_candidates = diff._hash_candidates
+        diff._hash_candidates = lambda files: batches.append(files) or hash_candidates(files)
+        items = diff.iterate()
+        self.assertEqual('file00', next(items)[0])
+        self.assertEqual(1, len(batches))
+        self.assertEqual(expected, tuple((item[0], item[2]) for item in [diff.list[0]] + list(items)))
+        self.assertEqual(5, len(batches))
+        self.assertTrue(all(len(files) <= 4 for files in batches))
+        self.assertEqual(20, sum(len(files) for files in batches))
+    
+    def test_prefetch(self):
+        stopped = threading.Event()
+        def items():
+            try:
+                yield from range(100000)
+            finally:
+                stopped.set()
+        prefetched = synkrotron._prefetch(items(), size=10, batch_size=2)
+        self.assertListEqual([0, 1, 2], [next(prefetched) for _ in range(3)])
+        prefetched.close() # the thread is blocked on the full queue
+        self.assertTrue(stopped.wait(5))
+        self.assertListEqual(list(range(5)), list(synkrotron._prefetch(iter(range(5)), size=4, batch_size=2)))
+    
     def test_diff_content_sshfs(self):
         remote = Remote('remote', self.remote_host, self.local1_ms)
         remote.mount()
@@ -174,6 +219,258 @@ class TestDiff(TestSynkrotron):
         remote.reverse_umount()
         remote.umount()
     
+    def test_direct_transfer(self):
+        # fake rsync that records its arguments and the list of files
+        bin_dir = os.path.join(self.dir, 'bin')
+        os.mkdir(bin_dir)
+        log = os.path.join(self.dir, 'log')
+        with io.open(os.path.join(bin_dir, 'rsync'), 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> %s\ncat >> %s\n' % (log, log))
+        os.chmod(os.path.join(bin_dir, 'rsync'), 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        agent = RemoteAgent(['sh', '-c'])
+        try:
+            self._populate(self.local1_base)
+            with io.open(os.path.join(self.remote, 'extra'), 'w') as f:
+                f.write('extra')
+            remote = Remote('remote', 'host:' + self.remote, self.local1_ms, direct_transfer=True)
+            self.assertTrue(remote.is_direct())
+            self.assertFalse(Remote('remote', self.remote, self.local1_ms, direct_transfer=True).is_direct())
+            remote._agent = agent
+            Diff(Repo(self.local1_base), Repo(remote)).push(delete=True)
+            self.assertFalse(os.path.exists(os.path.join(self.remote, 'extra'))) # deleted on the remote side
+            with io.open(log) as f:
+                lines = f.read().split('\n')
+            self.assertTrue(lines[0].endswith(' . host:%s/' % self.remote))
+            self.assertListEqual(['dir', 'dir/file_ä', 'file_ä'], lines[1:4])
+            os.remove(log)
+            self._populate(self.remote)
+            Diff(Repo(self.local2_base), Repo(remote)).pull()
+            with io.open(log) as f:
+                self.assertTrue(f.readline().strip().endswith(' host:%s/ %s' % (self.remote, self.local2_base)))
+        finally:
+            agent.close()
+            os.environ['PATH'] = path
+    
+    def test_direct_transfer_encrypted(self):
+        agent = RemoteAgent(['sh', '-c'])
+        try:
+            with io.open(os.path.join(self.remote, '.encfs6.xml'), 'w') as f:
+                f.write('<config/>')
+            remote = Remote('remote', 'host:' + self.remote, self.local1_ms, key=self.key, direct_transfer=True)
+            self.assertTrue(remote.is_direct())
+            remote._agent = agent
+            remote.connect()
+            self.assertIsNone(remote.mount_path) # not mounted
+            with io.open(os.path.join(remote.encfs_source, '.encfs6.xml')) as f:
+                self.assertEqual('<config/>', f.read())
+            remote_clear = remote.clear_remote()
+            self.assertEqual('host:' + os.path.join(self.remote, 'clear'), remote_clear.location)
+            self.assertTrue(remote_clear.is_direct())
+            self.assertIs(agent, remote_clear.agent())
+            # the staging directories are removed if decrypting the staged files fails
+            class IdentityCodec:
+                def map(self, command, names):
+                    return names
+                def close(self):
+                    pass
+            remote._name_codec = IdentityCodec()
+            bin_dir = os.path.join(self.dir, 'bin')
+            os.mkdir(bin_dir)
+            for program, code in (('rsync', 0), ('encfs', 1)):
+                with io.open(os.path.join(bin_dir, program), 'w') as f:
+                    f.write('#!/bin/sh\ncat > /dev/null\nexit %d\n' % code)
+                os.chmod(os.path.join(bin_dir, program), 0o755)
+            path = os.environ['PATH']
+            os.environ['PATH'] = bin_dir + os.pathsep + path
+            try:
+                diff = Diff(Repo(self.local1_base), Repo(remote))
+                diff.list = [('file', ('f', 3, 1.0), 'pull', 'local file does not exist')]
+                with self.assertRaises(Exception):
+                    diff.pull()
+            finally:
+                os.environ['PATH'] = path
+            self.assertFalse(os.path.exists(remote._sync_path('staging')))
+            self.assertFalse(os.path.exists(remote._sync_path('staging-clear')))
+            # deleting files does not need the (unmounted) directory, neither for encrypted nor for clear files
+            self.assertTrue(os.path.isdir(os.path.join(self.remote, 'clear')))
+            self._populate(self.remote)
+            self._populate(os.path.join(self.remote, 'clear'))
+            stdout = sys.stdout
+            sys.stdout = io.StringIO()
+            try:
+                Diff(Repo(self.local1_base), Repo(remote)).push(delete=True)
+                Diff(Repo(self.local1_base, rel_path='dir'), Repo(remote_clear, rel_path='dir')).push(delete=True)
+            finally:
+                sys.stdout = stdout
+            self.assertListEqual(['.encfs6.xml', 'clear'], sorted(os.listdir(self.remote)))
+            self.assertListEqual(['file_ä'], os.listdir(os.path.join(self.remote, 'clear')))
+        finally:
+            agent.close()
+    
+    def test_delete(self):
+        self._populate(self.local1_base)
+        self._populate(os.path.join(self.local1_base, 'dir', 'sub'))
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            Diff(Repo(self.local2_base), Repo(self.local1_base, exclude=['.synkrotron'])).push(delete=True, simulate=True)
+            self.assertTrue(os.path.exists(os.path.join(self.local1_base, 'dir', 'sub', 'file_ä')))
+            Diff(Repo(self.local2_base), Repo(self.local1_base, exclude=['.synkrotron'])).push(delete=True)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        deleted = ['file_ä', 'dir/sub/file_ä', 'dir/sub/dir/file_ä', 'dir/sub/dir', 'dir/sub', 'dir/file_ä', 'dir']
+        self.assertEqual(''.join('deleting %s (SIMULATION)\n' % f for f in deleted) + ''.join('deleting %s\n' % f for f in deleted), output)
+        self.assertListEqual(['.synkrotron'], os.listdir(self.local1_base))
+        # failing deletions are reported without stopping the others
+        self._populate(self.local1_base)
+        with io.open(os.path.join(self.local1_base, 'dir', 'excluded'), 'w') as f:
+            f.write('excluded')
+        sys.stdout = io.StringIO()
+        try:
+            diff = Diff(Repo(self.local2_base), Repo(self.local1_base, exclude=['.synkrotron', 'excluded']))
+            self.assertRaisesRegex(Exception, '1 of 3 files', diff.push, delete=True)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual('deleting file_ä\ndeleting dir/file_ä\nunable to delete dir (%s)\n' % os.strerror(39), output)
+        self.assertListEqual(['excluded'], os.listdir(os.path.join(self.local1_base, 'dir')))
+        self.assertListEqual(['.synkrotron', 'dir'], sorted(os.listdir(self.local1_base)))
+    
+    def test_transfer_shards(self):
+        # fake rsync that records the list of files and fails for directories
+        bin_dir = os.path.join(self.dir, 'bin')
+        os.mkdir(bin_dir)
+        log = os.path.join(self.dir, 'log')
+        with io.open(os.path.join(bin_dir, 'rsync'), 'w') as f:
+            f.write('#!/bin/sh\nfiles=$(cat)\necho "$files" >> %s\nif [ -d "$files" ]; then exit $FAIL_DIRS; fi\n' % log)
+        os.chmod(os.path.join(bin_dir, 'rsync'), 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            self._populate(self.local1_base)
+            os.environ['FAIL_DIRS'] = '0'
+            Diff(Repo(self.local1_base, exclude=['.synkrotron']), Repo(self.remote), transfer_shards=2).push()
+            with io.open(log) as f:
+                self.assertListEqual(['dir', 'dir/file_ä', 'file_ä'], sorted(f.read().split()))
+            os.remove(log)
+            os.environ['FAIL_DIRS'] = '23'
+            Diff(Repo(self.local1_base, exclude=['.synkrotron']), Repo(self.remote), transfer_shards=2).push()
+            with io.open(log) as f:
+                self.assertListEqual(['dir'], f.read().split()) # shards are skipped
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            os.environ['PATH'] = path
+            del os.environ['FAIL_DIRS']
+        self.assertIn('warning: rsync process creating directories failed (exit code: 23), 2 files were not transferred', output)
+    
+    def test_split_shards(self):
+        files = [('a', 100), ('b', 10), ('c', 60), ('d', 50), ('e', 0), ('f', 30)]
+        shards = Diff._split_shards(files, 2)
+        self.assertListEqual([[('a', 100), ('f', 30)], [('b', 10), ('c', 60), ('d', 50), ('e', 0)]], shards)
+        shards = Diff._split_shards(files, 4)
+        self.assertEqual(4, len(shards))
+        self.assertListEqual(files, sorted(f for shard in shards for f in shard))
+        self.assertListEqual([files[:1]], Diff._split_shards(files[:1], 4))
+        self.assertListEqual([], Diff._split_shards([], 4))
+    
+    def test_metrics(self):
+        metrics = Metrics()
+        with metrics.phase('mount'):
+            pass
+        items = [('dir', ('d', 0, 1.0)), ('dir/a', ('f', 10, 1.0)), ('dir/b', ('f', 5, 1.0))]
+        self.assertListEqual(items, list(metrics.iterate('collect local', items)))
+        metrics.add('transfer', files=2, size=15)
+        metrics.count_subprocess()
+        record = metrics.record(command='push')
+        self.assertEqual('push', record['command'])
+        self.assertListEqual(['mount', 'collect local', 'transfer'], list(record['phases']))
+        self.assertEqual(3, record['phases']['collect local']['files'])
+        self.assertEqual(15, record['phases']['collect local']['bytes'])
+        self.assertEqual(2, record['phases']['transfer']['files'])
+        self.assertEqual(1, record['subprocesses'])
+        self.assertGreater(record['peak_memory'], 0)
+        file = os.path.join(self.local1_base, 'stats.json')
+        metrics.write(file, command='push')
+        metrics.write(file, command='pull')
+        with open(file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertListEqual(['push', 'pull'], [line['command'] for line in lines])
+        self.assertEqual(15, lines[0]['phases']['transfer']['bytes'])
+    
+    def test_trace(self):
+        metrics = Metrics()
+        with metrics.phase('mount'):
+            pass
+        self.assertIsNone(metrics.trace_events)
+        metrics.enable_trace()
+        with metrics.phase('hash'):
+            with metrics.span('rsync', 'subprocess', argv='rsync -a') as span:
+                span['exit_code'] = 0
+        list(metrics.iterate('collect local', [('a', ('f', 3, 1.0))]))
+        file = os.path.join(self.local1_base, 'trace.json')
+        metrics.write_trace(file)
+        with open(file) as f:
+            events = json.load(f)['traceEvents']
+        self.assertListEqual(['rsync', 'hash', 'collect local'], [e['name'] for e in events])
+        self.assertListEqual(['subprocess', 'phase', 'phase'], [e['cat'] for e in events])
+        self.assertDictEqual({'argv': 'rsync -a', 'exit_code': 0}, events[0]['args'])
+        self.assertDictEqual({'files': 1, 'bytes': 3}, events[2]['args'])
+        for e in events:
+            self.assertEqual('X', e['ph'])
+            self.assertGreaterEqual(e['dur'], 0)
+        # spans of the outer phase enclose the inner spans
+        self.assertLessEqual(events[1]['ts'], events[0]['ts'])
+        # external programs are traced
+        synkrotron.metrics.enable_trace()
+        try:
+            self.assertEqual((0, b'x\n'), synkrotron.execute(['cat'], process_input='x', return_stdout=True))
+            event = synkrotron.metrics.trace_events[-1]
+        finally:
+            synkrotron.metrics.trace_events = None
+        self.assertEqual('cat', event['name'])
+        self.assertDictEqual({'argv': 'cat', 'cwd': None, 'input_bytes': 2, 'output_bytes': 2, 'exit_code': 0}, event['args'])
+        # keys are not traced
+        bin_dir = os.path.join(self.dir, 'bin')
+        os.mkdir(bin_dir)
+        with io.open(os.path.join(bin_dir, 'encfsctl'), 'w') as f:
+            f.write('#!/bin/sh\ncat > /dev/null\n')
+        os.chmod(os.path.join(bin_dir, 'encfsctl'), 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        synkrotron.metrics.enable_trace()
+        try:
+            codec = NameCodec('SECRETKEY', self.remote)
+            self.assertEqual(0, synkrotron.execute(codec._args('encode') + ['x'], process_input='SECRETKEY'))
+            file = os.path.join(self.local1_base, 'trace-key.json')
+            synkrotron.metrics.write_trace(file)
+        finally:
+            synkrotron.metrics.trace_events = None
+            os.environ['PATH'] = path
+        with open(file) as f:
+            trace = f.read()
+        self.assertIn('encfsctl', trace)
+        self.assertNotIn('SECRETKEY', trace)
+    
+    def test_diff_sorted(self):
+        for base in (self.local1_base, self.local2_base):
+            for name in ('a', 'a.b', 'a-b', 'b'):
+                os.mkdir(os.path.join(base, name))
+        for path in ('a/x', 'a-b/y', 'b/z'):
+            os.mkdir(os.path.join(self.local1_base, path))
+        for path in ('a/w', 'a.b/y', '-c'):
+            os.mkdir(os.path.join(self.local2_base, path))
+        diff = Diff(Repo(self.local1_base), Repo(self.local2_base))
+        items = list(diff.iterate())
+        self.assertEqual((('-c', 'pull'), ('a-b/y', 'push'), ('a.b/y', 'pull'), ('a/w', 'pull'), ('a/x', 'push'), ('b/z', 'push')), self._filter(diff))
+        self.assertListEqual(diff.list, items)
+        self.assertListEqual(sorted(Repo(self.local1_base).collect().items()), list(Repo(self.local1_base).iter_sorted()))
+    
     def test_pull(self):
         self._populate(self.remote)
         Diff(Repo(self.local1_base), Repo(self.remote)).pull()
@@ -244,6 +541,21 @@ class TestDiff(TestSynkrotron):
         diff = Diff(Repo(self.local1_base), Repo(self.local2_base), content=True)
         self.assertEqual(0, len(diff.compute()))
     
+    def test_force_stats(self):
+        for base, content, mtime in ((self.local1_base, 'short', 1e9), (self.local2_base, 'much longer content', 2e9)):
+            with io.open(os.path.join(base, 'file'), 'w') as f:
+                f.write(content)
+            os.utime(os.path.join(base, 'file'), (mtime, mtime))
+        copied = []
+        diff = Diff(Repo(self.local1_base, exclude=['.synkrotron']), Repo(self.local2_base, exclude=['.synkrotron']))
+        diff._rsync = lambda options, src, dst, cwd, copy_list: copied.extend(copy_list)
+        diff.push(force=True)
+        # the remote file is newer, but the local file is copied
+        self.assertListEqual([('file', ('f', 5, 1e9))], copied)
+        del copied[:]
+        diff.pull(force=True)
+        self.assertListEqual([('file', ('f', 19, 2e9))], copied)
+    
     def test_push_simulate(self):
         self._populate(self.local1_base)
         Diff(Repo(self.local1_base), Repo(self.remote)).push(simulate=True)
@@ -297,13 +609,13 @@ class TestDiff(TestSynkrotron):
         sys.stdout = output
         diff.compute(show=True, show_verbose=True)
         DiffStatistics(diff).show()
-        expected = '\n'.join(('Comparing 4 local files against 3 remote files...',
-                              '--> dir [remote file does not exist]',
+        expected = '\n'.join(('--> dir [remote file does not exist]',
                               '--> dir/file_ä (8.0 B) [remote file does not exist]',
                               '<-> file_ä (7.0 B/7.0 B) [files have different content; files have the same timestamp',
                               '    local file hash:  9a0364b9e99bb480dd25e1f0284c8555',
                               '    remote file hash: d57830865b3020a563b955b27320c31e]',
                               '<-- test [local file does not exist]',
+                              'Compared 4 local files against 3 remote files',
                               'pull: 1 files (0.0 B)',
                               'push: 2 files (8.0 B)',
                               'rest: 1 files (local: 7.0 B, remote: 7.0 B)',
@@ -344,6 +656,18 @@ class TestRepo(TestSynkrotron):
         self.assertEqual(('a',), tuple(Repo(self.local1_base, include=['dir'])._ignore_files('.', ['dir', 'a'], wl)))
         self.assertSetEqual({'dir'}, wl)
         self.assertEqual((), tuple(Repo(self.local1_base, include=['dir'])._ignore_files('dir', ['a'], wl)))
+        # white-listed directories are matched by path components
+        self.assertEqual(('dirx',), tuple(Repo(self.local1_base, include=['dir'])._ignore_files('.', ['dir', 'dirx'], wl)))
+        # the first matching include pattern determines whether a directory is white-listed
+        wl = set()
+        self.assertEqual((), tuple(Repo(self.local1_base, include=['a/b', 'a'])._ignore_files('.', ['a'], wl)))
+        self.assertSetEqual(set(), wl)
+        self.assertEqual((), tuple(Repo(self.local1_base, include=['a', 'a/b'])._ignore_files('.', ['a'], wl)))
+        self.assertSetEqual({'a'}, wl)
+        # patterns with several components
+        self.assertEqual(('x',), tuple(Repo(self.local1_base, exclude=['*/x'])._ignore_files('.', ['x', 'y'])))
+        self.assertEqual(('x',), tuple(Repo(self.local1_base, exclude=['a/*/x'])._ignore_files('a/b', ['x', 'y'])))
+        self.assertEqual((), tuple(Repo(self.local1_base, exclude=['a/*/x'])._ignore_files('b/b', ['x', 'y'])))
         
     
     def test_collect(self):
@@ -413,6 +737,142 @@ class TestRepo(TestSynkrotron):
         self.assertEqual('d', files['dir'][0])
         self.assertEqual('l', files['link'][0])
     
+    def test_collect_parallel(self):
+        self._populate(self.local1_base)
+        for i in range(5):
+            self._populate(os.path.join(self.local1_base, 'dir', 'sub%d' % i))
+        os.symlink(os.path.join(self.local1_base, 'dir'), os.path.join(self.local1_base, 'link'))
+        for preserve_links in (False, True):
+            expected = list(Repo(self.local1_base, preserve_links=preserve_links, exclude=['sub3'])._collect_local())
+            files = list(Repo(self.local1_base, preserve_links=preserve_links, exclude=['sub3'], walk_workers=4)._collect_local())
+            self.assertListEqual(expected, files)
+    
+    def test_file_table(self):
+        stats = {'.': ('d', 0, 1.0), 'a': ('d', 0, 2.0), 'a/b_ä': ('f', 3, 3.5), 'a-b': ('l', 4, 4.0), 'a/c/d': ('f', 2**40, 5.0), 'b': ('f', 0, 6.0)}
+        table = FileTable(stats.items())
+        self.assertEqual(6, len(table))
+        self.assertEqual(stats, table)
+        self.assertListEqual(sorted(stats.items()), list(table.items()))
+        self.assertListEqual(sorted(stats), list(table))
+        self.assertEqual(('f', 2**40, 5.0), table['a/c/d'])
+        self.assertNotIn('a/c', table)
+        self.assertIsNone(table.get('c'))
+        self.assertEqual(0, len(FileTable()))
+        # entries added in any order (including parents without entries) are sorted by path
+        stats.update({'x/y/z': ('f', 1, 7.0), 'a/c.': ('f', 1, 8.0), 'a/c/-': ('f', 1, 9.0), 'a,': ('f', 1, 10.0)})
+        table = FileTable()
+        for path in reversed(list(stats)):
+            table.append(path, stats[path])
+        table.sort()
+        self.assertListEqual(sorted(stats.items()), list(table.items()))
+        self.assertEqual(('f', 1, 9.0), table['a/c/-'])
+        self.assertNotIn('x/y', table)
+    
+    def test_pack_stats(self):
+        items = [('.', ('d', 0, 1.0)), ('a', ('d', 4096, 2.5)), ('a/b_ä', ('f', 2**40, 3.25)), ('a/bc', ('l', 3, 4.0)), ('b', ('f', 0, 5.0)), ('b\udcff', ('f', 1, 6.0))]
+        for compress in (False, True):
+            self.assertListEqual(items, list(Repo._unpack_stats(Repo._pack_stats(items, compress))))
+        self.assertListEqual([], list(Repo._unpack_stats(Repo._pack_stats([]))))
+    
+    def test_collect_index(self):
+        self._populate(self.local1_base)
+        self._fix_mtime(self.local1_base)
+        index_file = os.path.join(self.local1_ms, 'index')
+        expected = Repo(self.local1_base).collect()
+        self.assertEqual(expected, Repo(self.local1_base, index=FileIndex(index_file)).collect())
+        index = FileIndex(index_file)
+        self.assertEqual(expected, Repo(self.local1_base, index=index).collect())
+        index.save()
+        self.assertTrue(os.path.isfile(index_file))
+        # unchanged directories are not listed again
+        scandir = os.scandir
+        listed = []
+        os.scandir = lambda path: listed.append(path) or scandir(path)
+        try:
+            self.assertEqual(expected, Repo(self.local1_base).collect())
+            self.assertNotEqual([], listed) # directories are listed without index
+            del listed[:]
+            self.assertEqual(expected, Repo(self.local1_base, index=FileIndex(index_file)).collect())
+        finally:
+            os.scandir = scandir
+        self.assertEqual([], listed)
+        # new and removed files are detected
+        with io.open(os.path.join(self.local1_base, 'dir', 'new'), 'w') as f:
+            f.write('new')
+        os.remove(os.path.join(self.local1_base, 'file_ä'))
+        self.assertEqual(Repo(self.local1_base).collect(), Repo(self.local1_base, index=FileIndex(index_file)).collect())
+        # only names and stats are kept, and removed sub-trees are forgotten without touching other directories
+        for path in ('dir/sub', 'dir/sub/sub', 'dir-x', 'dir.x'):
+            os.mkdir(os.path.join(self.local1_base, path))
+        self._fix_mtime(self.local1_base, 1)
+        index = FileIndex(index_file)
+        Repo(self.local1_base, index=index).collect()
+        self.assertTrue(all(len(entry) == 2 for _, names in index._dirs.values() for entry in names.values()))
+        self.assertIn('dir/sub/sub', index._dirs)
+        shutil.rmtree(os.path.join(self.local1_base, 'dir'))
+        Repo(self.local1_base, index=index).collect()
+        self.assertListEqual(['.', 'dir-x', 'dir.x'], sorted(index._dirs))
+        self.assertListEqual(['dir-x', 'dir.x'], sorted(index._subdirs['.']))
+    
+    def test_collect_index_quick(self):
+        self._populate(self.local1_base)
+        self._fix_mtime(self.local1_base)
+        index_file = os.path.join(self.local1_ms, 'index')
+        index = FileIndex(index_file)
+        Repo(self.local1_base, index=index).collect()
+        index.save()
+        # modifying a file does not change the modification time of its directory
+        with io.open(os.path.join(self.local1_base, 'dir', 'file_ä'), 'w') as f:
+            f.write('modified content')
+        os.utime(os.path.join(self.local1_base, 'dir'), (0, 0))
+        files = Repo(self.local1_base, index=FileIndex(index_file, quick=True)).collect()
+        self.assertEqual(('f', 8), files['dir/file_ä'][:2])
+        files = Repo(self.local1_base, index=FileIndex(index_file)).collect()
+        self.assertEqual(('f', 16), files['dir/file_ä'][:2])
+        files = Repo(self.local1_base, index=FileIndex(index_file, rescan=True, quick=True)).collect()
+        self.assertEqual(('f', 16), files['dir/file_ä'][:2])
+    
+    def test_hash_cache(self):
+        self._populate(self.local1_base)
+        self._fix_mtime(self.local1_base)
+        cache_file = os.path.join(self.local1_ms, 'hashes')
+        files = ['file_ä', 'dir/file_ä']
+        expected = [(0, Repo._file_hash(os.path.join(self.local1_base, files[0]))), (1, Repo._file_hash(os.path.join(self.local1_base, files[1])))]
+        cache = HashCache(cache_file, self.local1_base)
+        self.assertListEqual(expected, sorted(Repo(self.local1_base, hash_cache=cache).file_hashes(files)))
+        cache.save()
+        file_hash = Repo._file_hash
+        hashed = []
+        Repo._file_hash = staticmethod(lambda file: hashed.append(file) or file_hash(file))
+        try:
+            # unchanged files are not read again
+            cache = HashCache(cache_file, self.local1_base)
+            self.assertListEqual(expected, sorted(Repo(self.local1_base, hash_cache=cache).file_hashes(files)))
+            self.assertListEqual([], hashed)
+            # changed files are hashed again
+            with io.open(os.path.join(self.local1_base, 'file_ä'), 'w') as f:
+                f.write('modified')
+            self._fix_mtime(self.local1_base)
+            self.assertNotEqual(expected[0], next(Repo(self.local1_base, hash_cache=cache).file_hashes(files[:1])))
+            self.assertEqual(1, len(hashed))
+        finally:
+            Repo._file_hash = file_hash
+        # hashes of deleted files are only evicted from listed directories
+        os.remove(os.path.join(self.local1_base, 'dir', 'file_ä'))
+        HashCache(cache_file, self.local1_base).save()
+        self.assertEqual(2, len(HashCache(cache_file, self.local1_base)._hashes))
+        cache = HashCache(cache_file, self.local1_base)
+        lexists = os.path.lexists
+        os.path.lexists = lambda path: self.fail('unexpected check of %s' % path)
+        try:
+            Repo(self.local1_base, hash_cache=cache).collect()
+            self.assertEqual({'.', 'dir'}, cache._visited) # only directories are recorded, listed files are marked in their entries
+            self.assertListEqual([('dir/file_ä', False), ('file_ä', True)], sorted((path, entry[4]) for path, entry in cache._hashes.items()))
+            cache.save()
+        finally:
+            os.path.lexists = lexists
+        self.assertEqual(['file_ä'], list(HashCache(cache_file, self.local1_base)._hashes))
+    
     def test_collect_remote(self):
         self._populate(self.remote)
         remote = Remote('remote', self.remote_host, self.local1_ms)
@@ -538,19 +998,148 @@ class TestRemote(TestSynkrotron):
         remote = Remote('remote', self.remote, self.local1_ms, key=self.key)
         remote.mount()
         clear = ['a/b', 'c', 'x/y/ ä']
-        remote.encrypt_names(clear)
-        self.assertEqual(6, len(remote._cache[0]))
-        self.assertEqual(6, len(remote._cache[1]))
-        self.assertTrue('y' in remote._cache[0].values())
-        self.assertTrue('y' in remote._cache[1].keys())
-        cache = remote._cache
+        encrypted = remote.encrypt_names(clear)
+        self.assertEqual(6, len(remote.name_cache))
+        self.assertEqual('y', remote.name_cache.decrypt(remote.name_cache.encrypt('y')))
         remote.save_cache()
-        del remote._cache
-        remote._load_cache()
-        self.assertSameElements(cache[0], remote._cache[0])
-        self.assertSameElements(cache[1], remote._cache[1])
+        remote.name_cache = None
+        self.assertEqual(6, len(remote._load_cache()))
+        self.assertListEqual(clear, remote.decrypt_names(encrypted))
         remote.umount()
     
+    def test_name_cache(self):
+        cache_file = os.path.join(self.local1_ms, 'names')
+        cache = NameCache(cache_file)
+        cache.store('a', 'A')
+        cache.store('b_ä', 'B')
+        self.assertEqual('A', cache.encrypt('a'))
+        self.assertEqual('b_ä', cache.decrypt('B'))
+        self.assertIsNone(cache.decrypt('a'))
+        self.assertIsNone(cache.encrypt('A'))
+        cache.save()
+        cache = NameCache(cache_file)
+        cache.store('c', 'C')
+        cache.save()
+        size = os.path.getsize(cache_file)
+        cache.save()
+        self.assertEqual(size, os.path.getsize(cache_file)) # only new entries are appended
+        cache = NameCache(cache_file, max_entries=2)
+        self.assertEqual(2, len(cache))
+        self.assertEqual('C', cache.encrypt('c'))
+        cache.store('d', 'D') # evicts the least recently used entry
+        self.assertIsNone(cache.encrypt('b_ä'))
+        cache.save()
+        cache = NameCache(cache_file)
+        self.assertEqual(2, len(cache))
+        self.assertEqual('d', cache.decrypt('D'))
+        cache.store('d', 'E') # remapped names drop their previous reverse entry
+        self.assertIsNone(cache.decrypt('D'))
+        self.assertEqual('d', cache.decrypt('E'))
+        cache.save()
+        cache = NameCache(cache_file)
+        self.assertIsNone(cache.decrypt('D'))
+        self.assertEqual('E', cache.encrypt('d'))
+        with io.open(cache_file, 'ab') as f:
+            f.write(b'\x00\x05x') # truncated record
+        self.assertEqual(2, len(NameCache(cache_file)))
+    
+    def test_name_cache_remap(self):
+        cache_file = os.path.join(self.local1_ms, 'names')
+        cache = NameCache(cache_file)
+        cache.store('a', 'x')
+        cache.save()
+        cache.store('a', 'y') # the clear name is mapped to a new encrypted name
+        self.assertIsNone(cache.decrypt('x'))
+        self.assertEqual('a', cache.decrypt('y'))
+        cache.store('b', 'y') # the encrypted name is mapped to a new clear name
+        self.assertIsNone(cache.encrypt('a'))
+        self.assertEqual('y', cache.encrypt('b'))
+        self.assertEqual(1, len(cache))
+        cache.save()
+        # the appended records are replayed in order when the cache is loaded again
+        cache = NameCache(cache_file, max_entries=1)
+        self.assertIsNone(cache.decrypt('x'))
+        self.assertIsNone(cache.encrypt('a'))
+        self.assertEqual('b', cache.decrypt('y'))
+        cache.store('c', 'z') # evicting the remapped entry leaves no reverse entry behind
+        self.assertIsNone(cache.decrypt('y'))
+        self.assertEqual('c', cache.decrypt('z'))
+    
+    def test_name_codec(self):
+        # fake encfsctl that prefixes names with the command and counts its invocations
+        bin_dir = os.path.join(self.dir, 'bin')
+        os.mkdir(bin_dir)
+        starts = os.path.join(self.dir, 'starts')
+        with io.open(os.path.join(bin_dir, 'encfsctl'), 'w') as f:
+            f.write('#!/bin/sh\necho >> %s\nwhile IFS= read -r line; do printf "%%s:%%s\\n" "$1" "$line"; done\n' % starts)
+        os.chmod(os.path.join(bin_dir, 'encfsctl'), 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        try:
+            codec = NameCodec(self.key, self.remote, pool_threshold=100, pool_size=4)
+            self.assertListEqual(['encode:a', 'encode: ä'], codec.map('encode', ['a', ' ä']))
+            self.assertListEqual(['encode:b'], codec.map('encode', ['b']))
+            self.assertListEqual(['decode:c', 'decode:'], codec.map('decode', ['c', '']))
+            names = ['n%d' % i for i in range(1000)]
+            self.assertListEqual(['encode:' + n for n in names], codec.map('encode', names))
+            codec.close()
+            with io.open(starts) as f:
+                self.assertEqual(2 + 4, len(f.readlines())) # one process per direction plus the pool
+        finally:
+            os.environ['PATH'] = path
+        # closing does not fail if a process terminated with unwritten names
+        codec = NameCodec(self.key, self.remote)
+        process = codec._processes['encode'] = subprocess.Popen(['true'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.wait()
+        process.stdin.write(b'name\n') # buffered, so writing fails when the pipe is closed
+        codec.close()
+        self.assertTrue(process.stdin.closed and process.stdout.closed)
+    
+    def _write_encfs_config(self, encfs_dir, cipher='ssl/aes'):
+        """Write an encfs configuration with a random volume key (encoded like encfs does)."""
+        salt = os.urandom(20)
+        codec = EncfsCodec.__new__(EncfsCodec)
+        codec.key_size = 24
+        codec._set_key(hashlib.pbkdf2_hmac('sha1', self.key.encode(), salt, 1000, 40))
+        volume_key = os.urandom(40)
+        checksum = codec._mac(volume_key, 32)
+        encoded_key = checksum.to_bytes(4, 'big') + codec._stream_encode(volume_key, checksum)
+        with io.open(os.path.join(encfs_dir, '.encfs6.xml'), 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<!DOCTYPE boost_serialization>\n'
+                    '<boost_serialization signature="serialization::archive" version="7">\n<cfg class_id="0" tracking_level="0" version="20">\n'
+                    '<cipherAlg class_id="1" tracking_level="0" version="0"><name>%s</name><major>3</major><minor>0</minor></cipherAlg>\n'
+                    '<nameAlg><name>nameio/block</name><major>4</major><minor>0</minor></nameAlg>\n'
+                    '<keySize>192</keySize><blockSize>1024</blockSize><uniqueIV>0</uniqueIV><chainedNameIV>0</chainedNameIV>\n'
+                    '<encodedKeySize>44</encodedKeySize><encodedKeyData>\n%s\n</encodedKeyData>\n'
+                    '<saltLen>20</saltLen><saltData>\n%s\n</saltData><kdfIterations>1000</kdfIterations>\n</cfg>\n</boost_serialization>\n'
+                    % (cipher, base64.b64encode(encoded_key).decode(), base64.b64encode(salt).decode()))
+    
+    def test_encfs_codec(self):
+        self._write_encfs_config(self.remote)
+        codec = EncfsCodec.load(self.key, self.remote)
+        names = ['a', 'file_ä', 'x' * 16, 'y' * 100, '.', '..', '']
+        encoded = codec.map('encode', names)
+        self.assertEqual(24, len(encoded[0])) # 2 bytes MAC + 16 bytes encrypted name in base64
+        self.assertEqual(46, len(encoded[2])) # 2 bytes MAC + 32 bytes (including a full padding block)
+        self.assertTrue(all(c.isalnum() or c in ',-' for c in encoded[1]))
+        self.assertListEqual(['.', '..', ''], encoded[-3:])
+        self.assertEqual(encoded, EncfsCodec.load(self.key, self.remote).map('encode', names))
+        self.assertListEqual(names, codec.map('decode', encoded))
+        self.assertIsNone(codec.decode_name(encoded[0][:-1] + ('A' if encoded[0][-1] != 'A' else 'B')))
+        self.assertIsNone(codec.decode_name('abc'))
+        self.assertIsNone(codec.decode_name('invalid!' * 4))
+        self.assertIsNone(EncfsCodec.load('wrong', self.remote))
+        self._write_encfs_config(self.remote, cipher='ssl/blowfish')
+        self.assertIsNone(EncfsCodec.load(self.key, self.remote))
+        self.assertIsNone(EncfsCodec.load(self.key, self.local1_base))
+    
+    def test_aes(self):
+        plain = bytes.fromhex('00112233445566778899aabbccddeeff')
+        for key_size, cipher in ((16, '69c4e0d86a7b0430d8cdb78070b4c55a'), (24, 'dda97ca4864cdfe06eaf70a0ec0d7191'), (32, '8ea2b7ca516745bfeafc49904b496089')):
+            round_keys = EncfsCodec._expand_key(bytes(range(key_size)))
+            self.assertEqual(cipher, EncfsCodec._encrypt_block(round_keys, plain).hex())
+            self.assertEqual(plain, EncfsCodec._decrypt_block(round_keys, bytes.fromhex(cipher)))
+    
     def test_reverse_mount(self):
         remote = Remote('remote', self.remote, self.local1_ms, key=self.key)
         remote.mount()
@@ -572,6 +1161,230 @@ class TestRemote(TestSynkrotron):
         remote.umount()
 
 
+class TestRemoteAgent(TestSynkrotron):
+    
+    def setUp(self):
+        super().setUp()
+        self.agent = RemoteAgent(['sh', '-c']) # local shell instead of ssh
+    
+    def tearDown(self):
+        self.agent.close()
+        super().tearDown()
+    
+    def test_list(self):
+        self._populate(self.remote)
+        files = dict(item for batch in self.agent.stream('walk', self.remote, {'rel_path': 'dir'}, 1) for item in Repo._unpack_stats(batch))
+        self.assertEqual(Repo(self.remote, rel_path='dir').collect(), files)
+    
+    def test_hash_stat(self):
+        self._populate(self.remote)
+        file = os.path.join(self.remote, 'file_ä')
+        self.assertEqual(Repo._file_hash(file), self.agent.call('hash', file))
+        self.assertEqual(('f', 7), self.agent.call('stat', file, False)[:2])
+        self.assertEqual('d', self.agent.call('stat', self.remote, False)[0])
+        self.assertIsNone(self.agent.call('stat', file + 'x', False))
+        with self.assertRaises(Exception):
+            self.agent.call('hash', file + 'x')
+    
+    def test_stream_hashes(self):
+        self._populate(self.remote)
+        files = [os.path.join(self.remote, 'file_ä'), os.path.join(self.remote, 'dir', 'file_ä')]
+        self.assertListEqual([(0, Repo._file_hash(files[0])), (1, Repo._file_hash(files[1]))], list(self.agent.stream('hashes', files, 1)))
+        self.assertListEqual([(0, Repo._file_hash(files[0])), (1, Repo._file_hash(files[1]))], sorted(self.agent.stream('hashes', files, 4)))
+    
+    def test_walk(self):
+        self._populate(self.remote)
+        os.mkdir(os.path.join(self.remote, 'dir.x'))
+        items = [item for batch in self.agent.stream('walk', self.remote, {}) for item in Repo._unpack_stats(batch)]
+        self.assertListEqual(list(Repo(self.remote).iter_sorted()), items)
+    
+    def test_collect_encrypted(self):
+        decoded = []
+        class IdentityCodec:
+            def map(self, command, names):
+                if command == 'decode':
+                    decoded.extend(names)
+                return names
+            def close(self):
+                pass
+        for d in ('foo', 'foo/x', 'foobar', 'bar', 'bar/foo'):
+            os.mkdir(os.path.join(self.remote, d))
+        remote = Remote('remote', 'localhost:' + self.remote, self.local1_ms, key=self.key)
+        remote._agent = self.agent
+        remote._name_codec = IdentityCodec() # names are not encrypted
+        remote.encfs_source = self.remote
+        files = Repo(remote, exclude=['f?o']).collect()
+        self.assertListEqual(['.', 'bar', 'foobar'], list(files))
+        self.assertNotIn('x', decoded) # excluded directories are not listed
+        for exclude in (['foo'], ['/bar/*'], ['*/foo'], ['x']):
+            for include in ([], ['foo'], ['f*']):
+                expected = Repo(self.remote, exclude=exclude, include=include).collect()
+                self.assertEqual(expected, Repo(remote, exclude=exclude, include=include).collect())
+        files = Repo(remote, exclude=['/bar/*']).collect()
+        self.assertListEqual(['.', 'bar', 'foo', 'foo/x', 'foobar'], list(files))
+        # files whose names can not be decrypted are skipped and never cached
+        os.mkdir(os.path.join(self.remote, 'bad'))
+        IdentityCodec.map = lambda self, command, names: [None if n == 'bad' else n for n in names]
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            for exclude in ([], ['f?o']):
+                files = Repo(remote, exclude=exclude).collect()
+                self.assertNotIn('bad', files)
+                self.assertIn('foobar', files)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual('warning: ignoring file "bad" (unable to decrypt name)\n' * 2, output)
+        self.assertIsNone(remote.name_cache.decrypt('bad'))
+        IdentityCodec.map = lambda self, command, names: ['' if n == 'bad' else n for n in names] # encfsctl prints empty lines
+        self.assertListEqual([None, 'foo/x'], remote.decrypt_names(['bad/x', 'foo/x']))
+        self.assertIsNone(remote.name_cache.decrypt('bad'))
+    
+    def test_concurrent_calls(self):
+        self._populate(self.remote)
+        files = [os.path.join(self.remote, 'file_ä'), os.path.join(self.remote, 'dir', 'file_ä')] * 20
+        with futures.ThreadPoolExecutor(max_workers=8) as executor:
+            hashes = list(executor.map(lambda f: self.agent.call('hash', f), files))
+        self.assertListEqual([Repo._file_hash(f) for f in files], hashes)
+    
+    def test_delete(self):
+        self._populate(self.remote)
+        self.assertEqual({}, self.agent.call('delete', self.remote, ['dir/file_ä', 'dir', 'file_ä']))
+        self.assertListEqual([], os.listdir(self.remote))
+        self._populate(self.remote)
+        failed = self.agent.call('delete', self.remote, ['missing', 'dir', 'file_ä'])
+        self.assertEqual([0, 1], sorted(failed))
+        self.assertListEqual(['dir'], os.listdir(self.remote))
+    
+    def test_loopback(self):
+        self._populate(self.remote)
+        remote = Remote('remote', 'host:' + self.remote, self.local1_ms, transport=LoopbackTransport())
+        try:
+            self.assertEqual(Repo(self.remote).collect(), Repo(remote).collect())
+            self.assertEqual(Repo._file_hash(os.path.join(self.remote, 'file_ä')), Repo(remote).file_hash('file_ä'))
+        finally:
+            remote.disconnect()
+        # every request takes at least one round trip
+        agent = RemoteAgent(LoopbackTransport(rtt=0.2).shell('host'))
+        try:
+            agent.call('stat', self.remote, False)
+            start = time.perf_counter()
+            self.assertEqual('d', agent.call('stat', self.remote, False)[0])
+            self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+        finally:
+            agent.close()
+        self.assertEqual((False, 'ls -l'), LoopbackTransport._parse_ssh_args(['host', 'ls', '-l']))
+        self.assertEqual((True, 'sftp'), LoopbackTransport._parse_ssh_args(['-x', '-o', 'ClearAllForwardings=yes', '-2', 'host', '-s', 'sftp']))
+        self.assertEqual('-e', LoopbackTransport().rsync_options()[0])
+        self.assertListEqual([], synkrotron.Transport().rsync_options())
+
+
+class TestBench(TestSynkrotron):
+    
+    def test_generate_tree(self):
+        local, remote = os.path.join(self.local1_base, 'tree'), os.path.join(self.local2_base, 'tree')
+        for d in (local, remote):
+            os.mkdir(d)
+            self.assertEqual(100, synkrotron_bench.generate_tree(d, files=100, depth=2, fanout=3))
+        self.assertEqual(Repo(local).collect(), Repo(remote).collect())
+        self.assertEqual(10, synkrotron_bench.change_tree(remote, change_rate=0.1))
+        diff = Diff(Repo(local), Repo(remote)).compute()
+        self.assertEqual(10, len(diff))
+    
+    def test_run_benchmarks(self):
+        results = synkrotron_bench.run_benchmarks(names=['collect', 'ignore', 'diff', 'statistics', 'names-cold', 'names-cached', 'remote-collect', 'remote-hash'],
+                                                  repeat=1, rtts=(0, 0.01), files=200, depth=2, fanout=4, exclude=['*.o', 'cache/*'])
+        self.assertListEqual(list(synkrotron_bench.Benchmark.benchmarks) + ['remote-collect@0ms', 'remote-hash@0ms', 'remote-collect@10ms', 'remote-hash@10ms'], list(results))
+        for items, seconds in results.values():
+            self.assertGreater(items, 0)
+            self.assertGreaterEqual(seconds, 0)
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            regressions = synkrotron_bench.compare(results, {'collect': results['collect'][1] / 10, 'ignore': results['ignore'][1] * 10})
+        finally:
+            sys.stdout = stdout
+        self.assertListEqual(['collect'], regressions)
+
+
+class TestWatcher(TestSynkrotron):
+    
+    def test_changes(self):
+        self._populate(self.local1_base)
+        watcher = Watcher(Repo(self.local1_base, exclude=['.synkrotron', '*.tmp']))
+        try:
+            self.assertSetEqual(set(), watcher.changes(timeout=0.1))
+            with io.open(os.path.join(self.local1_base, 'dir', 'file_ä'), 'a') as f:
+                f.write('x')
+            with io.open(os.path.join(self.local1_base, 'x.tmp'), 'w') as f:
+                f.write('x')
+            os.remove(os.path.join(self.local1_base, 'file_ä'))
+            os.makedirs(os.path.join(self.local1_base, 'new', 'sub'))
+            with io.open(os.path.join(self.local1_base, 'new', 'sub', 'file'), 'w') as f:
+                f.write('x')
+            self.assertSetEqual({'dir/file_ä', 'file_ä', 'new', 'new/sub', 'new/sub/file'}, watcher.changes(debounce=0.1, timeout=5))
+            # the new directories are watched
+            os.remove(os.path.join(self.local1_base, 'new', 'sub', 'file'))
+            self.assertSetEqual({'new/sub/file'}, watcher.changes(debounce=0.1, timeout=5))
+            # files modified in place are reported while they are still open and after they are closed
+            with io.open(os.path.join(self.local1_base, 'dir', 'file_ä'), 'r+') as f:
+                f.write('y')
+                f.flush()
+                self.assertSetEqual({'dir/file_ä'}, watcher.changes(debounce=0.1, timeout=5))
+            self.assertSetEqual({'dir/file_ä'}, watcher.changes(debounce=0.1, timeout=5))
+            # directories moved within the tree are watched at their new location, directories moved out of it are not watched anymore
+            os.rename(os.path.join(self.local1_base, 'new'), os.path.join(self.local1_base, 'moved'))
+            self.assertSetEqual({'new', 'moved', 'moved/sub'}, watcher.changes(debounce=0.1, timeout=5))
+            os.rename(os.path.join(self.local1_base, 'dir'), os.path.join(self.dir, 'outside'))
+            self.assertSetEqual({'dir'}, watcher.changes(debounce=0.1, timeout=5))
+            self.assertListEqual(['.', 'moved', 'moved/sub'], sorted(watcher._dirs.values()))
+            for path in (os.path.join(self.dir, 'outside', 'file'), os.path.join(self.local1_base, 'moved', 'sub', 'file')):
+                with io.open(path, 'w') as f:
+                    f.write('x')
+            self.assertSetEqual({'moved/sub/file'}, watcher.changes(debounce=0.1, timeout=5))
+        finally:
+            watcher.close()
+    
+    def test_include(self):
+        self._populate(self.local1_base)
+        os.mkdir(os.path.join(self.local1_base, 'dir', 'sub'))
+        watcher = Watcher(Repo(self.local1_base, include=['dir/sub'], rel_path='dir'))
+        try:
+            for path in ('dir/new', 'dir/sub/new'):
+                with io.open(os.path.join(self.local1_base, path), 'w') as f:
+                    f.write('x')
+            os.remove(os.path.join(self.local1_base, 'dir', 'file_ä'))
+            self.assertSetEqual({'dir/sub/new'}, watcher.changes(debounce=0.1, timeout=5))
+        finally:
+            watcher.close()
+        with self.assertRaises(Exception):
+            Watcher(Repo(self.local1_base, rel_path='file_ä'))
+    
+    def test_watch(self):
+        self._populate(self.local1_base)
+        watcher = Watcher(Repo(self.local1_base, exclude=['.synkrotron']))
+        calls = []
+        def synchronize(paths=None):
+            calls.append(paths)
+            if len(calls) == 1:
+                with io.open(os.path.join(self.local1_base, 'new'), 'w') as f:
+                    f.write('x')
+            elif len(calls) == 2:
+                watcher.overflow = True # lost events
+            else:
+                sys.exit(0)
+        with self.assertRaises(SystemExit):
+            synkrotron.watch(watcher, synchronize, debounce=0.1)
+        self.assertListEqual([None, ['new'], None], calls)
+        # all files are synchronized periodically
+        calls.clear()
+        watcher = Watcher(Repo(self.local1_base, exclude=['.synkrotron']))
+        with self.assertRaises(SystemExit):
+            synkrotron.watch(watcher, synchronize, debounce=0.1, reconcile=0.1)
+        self.assertListEqual([None, None, None], calls)
+
+
 class TestConfig(TestSynkrotron):
     
     def test_paths(self):
@@ -592,7 +1405,7 @@ class TestConfig(TestSynkrotron):
     def test_remotes(self):
         config = Config(self.local1_base)
         self.assertEqual(1, len(config.remotes))
-        self.assertEqual(12, len(config.remotes['remote']))
+        self.assertEqual(19, len(config.remotes['remote']))
         self.assertEqual(self.remote, config.remotes['remote']['location'])
         self.assertEqual('', config.remotes['remote']['key'])
         self.assertEqual('', config.remotes['remote']['mount_point'])
@@ -604,7 +1417,14 @@ class TestConfig(TestSynkrotron):
         self.assertEqual(0, config.remotes['remote']['content'])
         self.assertEqual('', config.remotes['remote']['clear'])
         self.assertEqual('', config.remotes['remote']['include'])
+        self.assertEqual(0, config.remotes['remote']['index'])
         self.assertEqual(0, config.remotes['remote']['force'])
+        self.assertEqual(1, config.remotes['remote']['walk_workers'])
+        self.assertEqual(0, config.remotes['remote']['hash_cache'])
+        self.assertEqual(0, config.remotes['remote']['hash_workers'])
+        self.assertEqual(0, config.remotes['remote']['name_cache_size'])
+        self.assertEqual(1, config.remotes['remote']['transfer_shards'])
+        self.assertEqual(0, config.remotes['remote']['direct_transfer'])
 
 
 class TestMain(TestSynkrotron):